@@ -7,12 +7,14 @@
 # Updated on 25 Jul 2017
 
 from __future__ import print_function, absolute_import, division
-import requests
 import argparse
 import PyFBA
 import os
 import sys
 import re
+from functools import partial
+from rest_client import (add_session_arguments, make_session_from_args,
+                         open_cache_from_args, session_get, fetch_kegg_entries)
 
 
 ###############################################################################
@@ -131,6 +133,7 @@ parser = argparse.ArgumentParser(description='Use PyFBA reaction IDs to '
 parser.add_argument('mseed_to_kegg', help='ModelSEED reaction mapper file')
 parser.add_argument('model_name', help='Model name')
 parser.add_argument('model_dir', help='Model directory')
+add_session_arguments(parser)
 parser.add_argument('-v', '--verbose', action='store_true',
                     help='Verbose output')
 
@@ -175,6 +178,25 @@ print('Model contains', str(model.number_of_reactions()), 'reactions',
 # Set KEGG API URL
 API_BASE_URL = 'http://rest.kegg.jp/'
 
+# HTTP session, keeping the connection to KEGG alive between requests
+SESSION, TIMEOUT = make_session_from_args(args)
+
+# Open response cache
+try:
+    RESPONSE_CACHE = open_cache_from_args(args)
+except ValueError as e:
+    sys.exit(str(e))
+
+# Fetch the KEGG entries of all model reactions in batches
+kegg_ids = sorted(set(mseed_to_kegg[mseed_rxn] for mseed_rxn in model.reactions
+                      if mseed_rxn in mseed_to_kegg))
+if args.verbose:
+    print('Fetching', str(len(kegg_ids)), 'KEGG entries', file=sys.stderr)
+kegg_entries = fetch_kegg_entries(kegg_ids,
+                                  partial(session_get, SESSION,
+                                          timeout=TIMEOUT),
+                                  API_BASE_URL, RESPONSE_CACHE)
+
 # Output header
 print('mseed_id', 'equation', 'kegg_id', 'name', 'ec','pathway', sep='\t')
 
@@ -189,17 +211,13 @@ for i, mseed_rxn in enumerate(model.reactions, start=1):
         print(mseed_rxn, 'not found in mapper. Skipping.', file=sys.stderr)
         continue
 
-    # Set resource path
-    resource = 'get/' + kegg_rxn
-
-    # Issue request
-    full_path = os.path.join(API_BASE_URL, resource)
-    response = requests.get(full_path)
+    # Look up response
+    status_code, text = kegg_entries[kegg_rxn]
 
     # Check that status code is 200 = good
-    if response.status_code != 200:
+    if status_code != 200:
         print('There was an error with the request: status code =',
-              response.status_code,
+              status_code,
               file=sys.stderr)
         print('ModelSEED id:', mseed_rxn, file=sys.stderr)
         print('KEGG id:', kegg_rxn, file=sys.stderr)
@@ -207,7 +225,7 @@ for i, mseed_rxn in enumerate(model.reactions, start=1):
               kegg_rxn, 'None', 'None', 'None', sep='\t')
         continue
 
-    if response.text.strip('\n') == '':
+    if text.strip('\n') == '':
         print('Response was empty for', kegg_rxn, file=sys.stderr)
         print(mseed_rxn, model.reactions[mseed_rxn].equation,
               kegg_rxn, 'None', 'None', 'None', sep='\t')
@@ -216,7 +234,13 @@ for i, mseed_rxn in enumerate(model.reactions, start=1):
     # Print reaction ID
     print(mseed_rxn, model.reactions[mseed_rxn].equation, kegg_rxn,
           end='', sep='\t')
-    parse_response(response.text, mseed_rxn, kegg_rxn)
+    parse_response(text, mseed_rxn, kegg_rxn)
+
+if RESPONSE_CACHE is not None:
+    if args.verbose:
+        print('\nResponse cache:', str(RESPONSE_CACHE.hits), 'hits,',
+              str(RESPONSE_CACHE.misses), 'misses', file=sys.stderr)
+    RESPONSE_CACHE.close()
 
 print('\nScript completed!', file=sys.stderr)
 
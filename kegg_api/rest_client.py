@@ -0,0 +1,447 @@
+# rest_client.py
+# HTTP session, response cache and batched KEGG requests shared by
+# reactions_to_kegg.py, misc/reactions_to_ko.py and
+# mgrast_api/mgrast-get-function-organism.py. The KEGG scripts share one
+# response cache file, so its layout and keys are defined only here.
+#
+# Created on 16 Oct 2026
+from __future__ import print_function, absolute_import, division
+import requests
+import os
+import sys
+import time
+import sqlite3
+import threading
+import random
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Response cache shared by the KEGG scripts
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'),
+                                  '.kegg_bigg_cache.sqlite')
+
+# Status codes retried by the sessions of make_session
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Version of the layout and keys of the response cache. Increase it when
+# either changes, so older cache files are rebuilt instead of misread
+CACHE_SCHEMA_VERSION = 1
+
+
+###############################################################################
+# FUNCTION DEFINITIONS
+###############################################################################
+class JitteredRetry(Retry):
+    """
+    Retry policy with full jitter: each wait is drawn at random between zero
+    and the exponential backoff time, so requests that failed together do not
+    all retry at the same moment.
+    """
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, backoff)
+
+
+def make_session(pool_size, retries, backoff, read_retries=None):
+    """
+    Create an HTTP session that keeps connections alive and reuses them
+    between requests. Connection errors, read errors and timeouts and
+    429/5xx responses are retried with jittered exponential backoff,
+    following the Retry-After header when the server sends one. Once the
+    retries are exhausted, the last response is returned with its status code.
+
+    :param pool_size: Maximum open connections to each host
+    :type pool_size: int
+    :param retries: Maximum retries of each request
+    :type retries: int
+    :param backoff: Backoff factor in seconds, doubled after each retry
+    :type backoff: float
+    :param read_retries: Maximum retries after a read error or timeout, the
+    same as retries if None
+    :type read_retries: int
+    :return: HTTP session
+    :rtype: requests.Session
+    """
+    if read_retries is None:
+        read_retries = retries
+    retry = JitteredRetry(total=retries, connect=retries, read=read_retries,
+                          status=retries, backoff_factor=backoff,
+                          status_forcelist=RETRY_STATUS_CODES,
+                          respect_retry_after_header=True,
+                          raise_on_status=False)
+    # Requests wait for a free connection when the pool of a host is full
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_size,
+                          pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def add_session_arguments(parser, timeout=60, read_retries=None, cache=True):
+    """
+    Add the options of make_session_from_args, and of open_cache_from_args if
+    the script uses the response cache, to an argument parser. A script whose
+    server needs other defaults passes them here, and they are shown in the
+    help.
+
+    :param parser: Argument parser
+    :type parser: argparse.ArgumentParser
+    :param timeout: Default read timeout in seconds, None to wait until the
+    server answers
+    :type timeout: float
+    :param read_retries: Default retries after a read error or timeout, None
+    for the same as --retries
+    :type read_retries: int
+    :param cache: Add the response cache options
+    :type cache: bool
+    """
+    parser.add_argument('--connect_timeout', type=float, default=10,
+                        help='Seconds to wait for a connection to the server '
+                        '[default: 10]')
+    parser.add_argument('--timeout', type=float, default=timeout,
+                        help='Seconds to wait for the server to send data '
+                        '[default: ' + ('wait until the server answers'
+                                        if timeout is None else
+                                        '%g' % timeout) + ']')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Maximum retries of a request after a connection '
+                        'error, read error or timeout, or 429/5xx response '
+                        '[default: 5]')
+    parser.add_argument('--read_retries', type=int, default=read_retries,
+                        help='Maximum retries after a read error or timeout, '
+                        'at most --retries [default: ' +
+                        ('same as --retries' if read_retries is None else
+                         str(read_retries)) + ']')
+    parser.add_argument('--backoff', type=float, default=1,
+                        help='Backoff factor in seconds between retries, '
+                        'doubled after each retry and jittered [default: 1]')
+    if not cache:
+        return
+    parser.add_argument('--cache_file', default=DEFAULT_CACHE_FILE,
+                        help='SQLite cache of the KEGG and BiGG responses, '
+                        'shared by reactions_to_kegg.py and '
+                        'reactions_to_ko.py '
+                        '[default: ~/.kegg_bigg_cache.sqlite]')
+    parser.add_argument('--cache_ttl', type=float, default=30,
+                        help='Days before a cached response is fetched again '
+                        '[default: 30]')
+    parser.add_argument('--cache_size', type=float, default=500,
+                        help='Maximum size of the cached responses in MB '
+                        '[default: 500]')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Do not read or write the response cache')
+
+
+def make_session_from_args(args, pool_size=1):
+    """
+    Create the HTTP session of make_session with the options of
+    add_session_arguments.
+
+    :param args: Parsed arguments
+    :type args: argparse.Namespace
+    :param pool_size: Maximum open connections to each host
+    :type pool_size: int
+    :return: HTTP session, and the connect and read timeouts for session_get
+    :rtype: tuple
+    """
+    session = make_session(pool_size, args.retries, args.backoff,
+                           args.read_retries)
+    return session, (args.connect_timeout, args.timeout)
+
+
+def open_cache_from_args(args):
+    """
+    Open the response cache with the options of add_session_arguments.
+    Raises a ValueError if the cache file can not be used.
+
+    :param args: Parsed arguments
+    :type args: argparse.Namespace
+    :return: Response cache, or None with --no_cache
+    :rtype: ResponseCache
+    """
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache_file, args.cache_ttl, args.cache_size)
+
+
+class FailedResponse(object):
+    """
+    Stand-in for a request that failed without a response, like a connection
+    error or a timeout once the retries are exhausted. The status code is the
+    name of the error, so the failure is logged like a failed response.
+    """
+    def __init__(self, error):
+        self.status_code = type(error).__name__
+        self.text = ''
+
+
+def session_get(session, url, timeout, params=None):
+    """
+    Issue a GET request through an HTTP session. A request that fails without
+    a response is reported and returns a FailedResponse.
+
+    :param session: HTTP session
+    :type session: requests.Session
+    :param url: Request URL
+    :type url: str
+    :param timeout: Connect and read timeouts in seconds
+    :type timeout: tuple
+    :param params: Query parameters
+    :type params: dict
+    :return: API response
+    :rtype: requests.Response or FailedResponse
+    """
+    try:
+        return session.get(url, params=params, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print('Request failed:', url + ':', str(e), file=sys.stderr)
+        sys.stderr.flush()
+        return FailedResponse(e)
+
+
+class ResponseCache(object):
+    """
+    SQLite cache of API responses, keyed by endpoint and ID. Entries older
+    than the time to live are fetched again, and the least recently used
+    entries are evicted when the cache grows over its maximum size. Safe to
+    use from several threads.
+
+    The file keeps CACHE_SCHEMA_VERSION as its user_version. A file from an
+    older version is emptied and rebuilt, and a file from a newer version is
+    refused, since its entries could be read with the wrong keys.
+    """
+    def __init__(self, cache_file, ttl_days, max_size_mb):
+        """
+        :param cache_file: SQLite file path
+        :type cache_file: str
+        :param ttl_days: Days before an entry is fetched again
+        :type ttl_days: float
+        :param max_size_mb: Maximum size of the cached responses in MB
+        :type max_size_mb: float
+        """
+        self.ttl = ttl_days * 86400
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cache_file, check_same_thread=False)
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version > CACHE_SCHEMA_VERSION:
+            self.db.close()
+            raise ValueError('Response cache ' + cache_file + ' was made by '
+                             'a newer version (' + str(version) + '), use '
+                             'another --cache_file')
+        if version < CACHE_SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS responses')
+            self.db.execute('PRAGMA user_version = ' +
+                            str(CACHE_SCHEMA_VERSION))
+
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'endpoint TEXT, entry_id TEXT, body TEXT, '
+                        'size INTEGER, fetched REAL, accessed REAL, '
+                        'PRIMARY KEY (endpoint, entry_id))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                        'ON responses (accessed)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) '
+                                    'FROM responses').fetchone()[0]
+
+    def get(self, endpoint, entry_id, any_age=False):
+        """
+        Return the cached response text, or None if it is missing or expired.
+
+        :param endpoint: API endpoint URL
+        :type endpoint: str
+        :param entry_id: Entry ID
+        :type entry_id: str
+        :param any_age: Return expired entries too, for runs without requests
+        :type any_age: bool
+        :return: Response text
+        :rtype: str
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT body, fetched FROM responses '
+                                  'WHERE endpoint = ? AND entry_id = ?',
+                                  (endpoint, entry_id)).fetchone()
+            if row is None or (not any_age and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? '
+                            'WHERE endpoint = ? AND entry_id = ?',
+                            (now, endpoint, entry_id))
+            self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, endpoint, entry_id, body):
+        """
+        Store a response text, evicting the least recently used entries if
+        the cache is over its maximum size.
+
+        :param endpoint: API endpoint URL
+        :type endpoint: str
+        :param entry_id: Entry ID
+        :type entry_id: str
+        :param body: Response text
+        :type body: str
+        """
+        now = time.time()
+        size = len(body.encode('utf-8'))
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses '
+                                  'WHERE endpoint = ? AND entry_id = ?',
+                                  (endpoint, entry_id)).fetchone()
+            if old is not None:
+                self.size -= old[0]
+            self.db.execute('INSERT OR REPLACE INTO responses '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (endpoint, entry_id, body, size, now, now))
+            self.size += size
+
+            # Evict least recently used entries
+            while self.size > self.max_size:
+                rows = self.db.execute('SELECT endpoint, entry_id, size '
+                                       'FROM responses ORDER BY accessed '
+                                       'LIMIT 100').fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    if self.size <= self.max_size:
+                        break
+                    self.db.execute('DELETE FROM responses '
+                                    'WHERE endpoint = ? AND entry_id = ?',
+                                    row[:2])
+                    self.size -= row[2]
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def split_kegg_records(text):
+    """
+    Split a KEGG flat file response with several entries into records. Each
+    record ends with its /// line, like the response for a single entry.
+
+    :param text: API response text
+    :type text: str
+    :return: KEGG records
+    :rtype: list
+    """
+    records = []
+    record = []
+    for line in text.split('\n'):
+        record.append(line)
+        if line.startswith('///'):
+            records.append('\n'.join(record) + '\n')
+            record = []
+    return records
+
+
+def kegg_record_id(record):
+    """
+    Return the ID in the ENTRY line of a KEGG record. Enzyme entries have the
+    form "EC 1.1.1.1", and the EC number is returned.
+
+    :param record: KEGG record
+    :type record: str
+    :return: Entry ID
+    :rtype: str
+    """
+    for line in record.split('\n'):
+        if line.startswith('ENTRY'):
+            fields = line[12:].split()
+            if len(fields) > 1 and fields[0] == 'EC':
+                return fields[1]
+            elif fields:
+                return fields[0]
+    return None
+
+
+def fetch_kegg_batch(kegg_ids, get, base_url, response_cache=None):
+    """
+    Get up to 10 KEGG entries in a single request, and split the response
+    back to each ID by the ENTRY line of its record. Records are added to the
+    response cache one by one. KEGG leaves the IDs it does not know out of the
+    response, so they get the 404 status code of a request on their own,
+    without sending it.
+
+    :param kegg_ids: KEGG IDs, up to 10
+    :type kegg_ids: list
+    :param get: Function that issues a GET request for a URL
+    :type get: function
+    :param base_url: KEGG API base URL
+    :type base_url: str
+    :param response_cache: Response cache, or None
+    :type response_cache: ResponseCache
+    :return: Status code and record text of each ID, empty if not returned
+    :rtype: dict
+    """
+    endpoint = os.path.join(base_url, 'get')
+    response = get(os.path.join(endpoint, '+'.join(kegg_ids)))
+
+    # The whole batch failed
+    if response.status_code != 200:
+        return {kegg_id: (response.status_code, '') for kegg_id in kegg_ids}
+
+    records = {}
+    for record in split_kegg_records(response.text):
+        records[kegg_record_id(record)] = record
+
+    entries = {}
+    for kegg_id in kegg_ids:
+        # IDs can have a database prefix, like rn:R00001 or ec:1.1.1.1
+        record = records.get(kegg_id.split(':')[-1])
+        if record is None:
+            entries[kegg_id] = (404, '')
+            continue
+        if response_cache is not None:
+            response_cache.put(endpoint, kegg_id, record)
+        entries[kegg_id] = (200, record)
+    return entries
+
+
+def fetch_kegg_entries(kegg_ids, get, base_url, response_cache=None,
+                       batch_size=10, map_function=map):
+    """
+    Get the KEGG entries of all IDs, from the response cache or in batches of
+    up to batch_size IDs per request, sent through the map function.
+
+    :param kegg_ids: Distinct KEGG IDs
+    :type kegg_ids: list
+    :param get: Function that issues a GET request for a URL
+    :type get: function
+    :param base_url: KEGG API base URL
+    :type base_url: str
+    :param response_cache: Response cache, or None
+    :type response_cache: ResponseCache
+    :param batch_size: Maximum IDs per request, 10 for KEGG
+    :type batch_size: int
+    :param map_function: Map of the batches, like the map of a thread pool
+    :type map_function: function
+    :return: Status code and record text of each ID
+    :rtype: dict
+    """
+    endpoint = os.path.join(base_url, 'get')
+    entries = {}
+    missing_ids = []
+    for kegg_id in kegg_ids:
+        body = None
+        if response_cache is not None:
+            body = response_cache.get(endpoint, kegg_id)
+        if body is not None:
+            entries[kegg_id] = (200, body)
+        else:
+            missing_ids.append(kegg_id)
+
+    batches = [missing_ids[i:i + batch_size]
+               for i in range(0, len(missing_ids), batch_size)]
+    fetch_batch = partial(fetch_kegg_batch, get=get, base_url=base_url,
+                          response_cache=response_cache)
+    for batch_entries in map_function(fetch_batch, batches):
+        entries.update(batch_entries)
+    return entries
@@ -8,7 +8,6 @@
 # Updated on 23 Jan 2018
 
 from __future__ import absolute_import, print_function
-import requests
 import os
 import sys
 import argparse
@@ -16,6 +15,12 @@ import re
 import time
 import datetime
 
+# The HTTP session is shared with the KEGG scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'kegg_api'))
+from rest_client import add_session_arguments, make_session_from_args, \
+    session_get
+
 
 ###############################################################################
 # FUNCTION DEFINITIONS
@@ -54,6 +59,10 @@ parser.add_argument("--auth", help="MG-RAST authentication key")
 parser.add_argument("--source", help="Database source to use",
                     choices=["RefSeq", "GenBank", "SEED", "PATRIC", "KEGG",
                              "SwissProt"], default="SEED")
+# No read timeout and no read retries by default: the annotation query can run
+# for minutes before the server answers, and sending it again only starts it
+# over. A metagenome is skipped once its retries are exhausted
+add_session_arguments(parser, timeout=None, read_retries=0, cache=False)
 parser.add_argument('-v', '--verbose', action='store_true',
                     help='Verbose output')
 
@@ -81,6 +90,9 @@ if auth:
 if minLen:
     myParams["length"] = minLen
 
+# HTTP session, keeping the connection to MG-RAST alive between requests
+session, timeout = make_session_from_args(args)
+
 # Print out options
 print("***********************************************", file=sys.stderr)
 print("Running mgrast-get-function-organism.py", file=sys.stderr)
@@ -111,7 +123,7 @@ with open(args.mgfile, "r") as mgf:
 
         # Issue request
         full_url = os.path.join(API_BASE_URL, mgID)
-        response = requests.get(full_url, params=myParams)
+        response = session_get(session, full_url, timeout, params=myParams)
 
         # Check that status code is 200 = good
         if response.status_code != 200:
@@ -172,4 +184,5 @@ with open(args.mgfile, "r") as mgf:
             print_status(mgID + " parsing complete")
 
 fout.close()
+session.close()
 print_status("Script complete.")
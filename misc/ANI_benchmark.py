@@ -0,0 +1,498 @@
+#!/usr/local/bin/python3
+# ANI_benchmark.py
+# Benchmark the Python side of ANI_blastn.py on synthetic genome families.
+# Genomes descend from a common ancestor through families with a controlled
+# divergence. BLAST results come from fake_blast.py, so the benchmark runs
+# without BLAST+ and gives the same hits every time. Each run is appended to a
+# history file with the git commit, to follow the timings across commits.
+#
+# Created on 16 Oct 2026
+from __future__ import print_function, absolute_import, division
+import sys
+import os
+import json
+import time
+import datetime
+import argparse
+import subprocess
+import timeit
+import numpy as np
+
+# ANI_blastn.py and fake_blast.py are next to this script
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+import ANI_blastn
+import fake_blast
+
+
+###############################################################################
+# FUNCTION DEFINITIONS
+###############################################################################
+def timestamp():
+    """
+    Return time stamp.
+    """
+    t = time.time()
+    fmt = '[%Y-%m-%d %H:%M:%S]'
+    return datetime.datetime.fromtimestamp(t).strftime(fmt)
+
+
+def print_status(msg, end='\n'):
+    """
+    Print status message.
+    """
+    print('{}    {}'.format(timestamp(), msg), file=sys.stderr, end=end)
+    sys.stderr.flush()
+
+
+def mutate(codes, rate, rng):
+    """
+    Substitute a fraction of the bases of a sequence.
+
+    :param codes: Sequence as an array of base codes (0 to 3)
+    :type codes: numpy.ndarray
+    :param rate: Probability of substitution of each base
+    :type rate: float
+    :param rng: Random number generator
+    :type rng: numpy.random.RandomState
+    :return: Mutated copy of the sequence
+    :rtype: numpy.ndarray
+    """
+    codes = codes.copy()
+    substituted = rng.random_sample(len(codes)) < rate
+    # Shifting the code by 1 to 3 always gives a different base
+    shift = rng.randint(1, 4, substituted.sum())
+    codes[substituted] = (codes[substituted] + shift) % 4
+    return codes
+
+
+def make_genome_families(n_genomes, genome_length, n_families,
+                         family_divergence, member_divergence, n_contigs,
+                         seed):
+    """
+    Make synthetic genomes. Each family root differs from the ancestor by
+    family_divergence, and each genome differs from its family root by up to
+    member_divergence. Genomes are cut in contigs and carry a short run of Ns.
+
+    :return: Genome name to list of contigs, and genome name to (family,
+             member divergence)
+    :rtype: tuple
+    """
+    rng = np.random.RandomState(seed)
+    bases = np.array(list('ACGT'))
+    ancestor = rng.randint(0, 4, genome_length)
+    roots = [mutate(ancestor, family_divergence, rng)
+             for family in range(n_families)]
+
+    genomes = {}
+    lineage = {}
+    for genome_number in range(n_genomes):
+        family = genome_number % n_families
+        divergence = rng.uniform(0, member_divergence)
+        codes = mutate(roots[family], divergence, rng)
+
+        sequence = ''.join(bases[codes])
+        sequence = sequence[:genome_length // 3] + 'N' * 10 + \
+            sequence[genome_length // 3:]
+        cuts = np.linspace(0, len(sequence), n_contigs + 1).astype(int)
+
+        name = 'genome_%04d' % genome_number
+        genomes[name] = [sequence[cuts[i]:cuts[i + 1]]
+                         for i in range(n_contigs)]
+        lineage[name] = (family, divergence)
+
+    return genomes, lineage
+
+
+def expected_ani(lineage_a, lineage_b, family_divergence):
+    """
+    Expected ANI between two synthetic genomes, from their divergence to the
+    closest common root.
+    """
+    family_a, divergence_a = lineage_a
+    family_b, divergence_b = lineage_b
+    identity = (1 - divergence_a) * (1 - divergence_b)
+    if family_a != family_b:
+        identity *= (1 - family_divergence) ** 2
+    return 100 * identity
+
+
+def write_genome_files(genomes, genome_dir):
+    """
+    Write each genome to genome_dir as a fasta file, one entry per contig.
+
+    :return: Genome name to fasta file
+    :rtype: dict
+    """
+    if not os.path.isdir(genome_dir):
+        os.makedirs(genome_dir)
+    genome_files = {}
+    for name in sorted(genomes):
+        genome_file = os.path.join(genome_dir, name + '.fna')
+        with open(genome_file, 'w') as f:
+            for i, contig in enumerate(genomes[name], start=1):
+                f.write('>contig' + str(i) + '\n' + contig + '\n')
+        genome_files[name] = genome_file
+    return genome_files
+
+
+def make_fragments(genome_file, fragment_size):
+    """
+    Fragments of a genome, cut by the fragmenter of ANI_blastn.py and named
+    like its query fragments.
+    """
+    fragments = []
+    for contig, contig_size in ANI_blastn.read_fasta_contigs(genome_file):
+        for fragment in ANI_blastn.iter_sequence_fragments(contig,
+                                                           fragment_size):
+            fragments.append(fragment.tobytes().decode('ascii'))
+    return [('Fragment' + str(i), fragment)
+            for i, fragment in enumerate(fragments, start=1)]
+
+
+def time_call(function, *arguments):
+    """
+    Run a function and return the seconds it took and its result.
+    """
+    start = timeit.default_timer()
+    result = function(*arguments)
+    return timeit.default_timer() - start, result
+
+
+def benchmark_scale(n_genomes, args, work_dir):
+    """
+    Time the Python side of ANI_blastn.py for a collection of n_genomes.
+
+    :return: Timings and throughput of each function
+    :rtype: dict
+    """
+    results = {}
+
+    print_status('Making ' + str(n_genomes) + ' synthetic genomes')
+    seconds, (genomes, lineage) = time_call(
+        make_genome_families, n_genomes, args.genome_length, args.families,
+        args.family_divergence, args.member_divergence, args.contigs,
+        args.seed)
+    names = sorted(genomes)
+    results['genome_generation_s'] = seconds
+
+    genome_files = write_genome_files(genomes,
+                                      os.path.join(work_dir, 'genomes'))
+
+    # Fragmenting every genome from its fasta file, as ANI_blastn.py does
+    print_status('Timing write_query_fragments')
+    n_fragments = 0
+    seconds = 0.0
+    fragments_file = os.path.join(work_dir, 'query_fragments.fna')
+    for name in names:
+        time_spent, (fragment_lengths, query_stats) = time_call(
+            ANI_blastn.write_query_fragments, genome_files[name],
+            fragments_file, args.fragment_size)
+        seconds += time_spent
+        n_fragments += len(fragment_lengths)
+    os.remove(fragments_file)
+    results['write_query_fragments_s'] = seconds
+    results['fragments_per_s'] = n_fragments / seconds if seconds else 0.0
+
+    # Top hits and ANI for a sample of the pairs, always the same sample
+    rng = np.random.RandomState(args.seed)
+    n_pairs = n_genomes * (n_genomes - 1)
+    sample = rng.choice(n_pairs, min(args.max_pairs, n_pairs), replace=False)
+    print_status('Timing the top hits and ANI of ' + str(len(sample)) +
+                 ' pairs')
+    timings = dict.fromkeys(['get_blast_top_hit', 'calculate_ani',
+                             'read_blast_top_hit_arrays',
+                             'calculate_ani_arrays'], 0.0)
+    n_lines = 0
+    blast_file = os.path.join(work_dir, 'blast_results.txt')
+    for pair_index in sorted(sample):
+        reference = names[pair_index // (n_genomes - 1)]
+        query = [name for name in names if name != reference][
+            pair_index % (n_genomes - 1)]
+
+        fragments = make_fragments(genome_files[query], args.fragment_size)
+        subjects = [('contig' + str(i), contig) for i, contig in
+                    enumerate(genomes[reference], start=1)]
+        with open(blast_file, 'w') as f:
+            for line in fake_blast.blast_fragments(fragments, subjects):
+                f.write(line)
+                n_lines += 1
+
+        fragment_lengths = [len(fragment) for name, fragment in fragments]
+        length_dict = dict(('Fragment' + str(i), length) for i, length in
+                           enumerate(fragment_lengths, start=1))
+
+        seconds, top_hits = time_call(ANI_blastn.get_blast_top_hit,
+                                      blast_file)
+        timings['get_blast_top_hit'] += seconds
+        seconds, values = time_call(ANI_blastn.calculate_ani, top_hits,
+                                    length_dict)
+        timings['calculate_ani'] += seconds
+
+        with open(blast_file, 'r') as f:
+            seconds, arrays = time_call(ANI_blastn.read_blast_top_hit_arrays,
+                                        f, len(fragment_lengths))
+        timings['read_blast_top_hit_arrays'] += seconds
+        seconds, values = time_call(ANI_blastn.calculate_ani_arrays,
+                                    *(arrays + (fragment_lengths,)))
+        timings['calculate_ani_arrays'] += seconds
+    os.remove(blast_file)
+
+    for function in timings:
+        results[function + '_s'] = timings[function]
+        results[function + '_per_pair_s'] = timings[function] / len(sample)
+        results[function + '_all_pairs_s'] = \
+            timings[function] / len(sample) * n_pairs
+    results['blast_lines_per_s'] = \
+        n_lines / timings['get_blast_top_hit'] \
+        if timings['get_blast_top_hit'] else 0.0
+    results['sampled_pairs'] = len(sample)
+
+    # Matrix of all the pairs in both directions, with the expected ANI of
+    # the synthetic genomes, filled pair by pair as ANI_blastn.py does
+    print_status('Timing create_distance_matrix and add_pair_distance')
+    ani_results = {}
+    for i, reference in enumerate(names):
+        for query in names[i + 1:]:
+            ani = expected_ani(lineage[reference], lineage[query],
+                               args.family_divergence)
+            ani_results[(reference, query)] = ani
+            ani_results[(query, reference)] = ani
+    start = timeit.default_timer()
+    rows, cols, matrix = ANI_blastn.create_distance_matrix(names)
+    for genome_pair, ani in ani_results.items():
+        ANI_blastn.add_pair_distance(matrix, rows, genome_pair, ani, True)
+    results['create_distance_matrix_s'] = timeit.default_timer() - start
+
+    if args.end_to_end and n_genomes <= args.end_to_end_max:
+        results['end_to_end_s'] = run_end_to_end(genome_files, args,
+                                                 work_dir)
+
+    if args.check_all_vs_all and n_genomes <= args.end_to_end_max:
+        results['all_vs_all_max_difference'] = check_all_vs_all(genome_files,
+                                                                work_dir)
+
+    return results
+
+
+def install_fake_blast(bin_dir):
+    """
+    Write makeblastdb and blastn commands that run fake_blast.py.
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    for program in ('makeblastdb', 'blastn'):
+        command_file = os.path.join(bin_dir, program)
+        with open(command_file, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+                sys.executable, os.path.join(SCRIPT_DIR, 'fake_blast.py'),
+                program))
+        os.chmod(command_file, 0o755)
+
+
+def run_ani_blastn(genome_files, work_dir, output_name, ani_options):
+    """
+    Run ANI_blastn.py on the genome fasta files with the fake BLAST commands.
+
+    :return: Wall time of the run in seconds, and its output directory
+    :rtype: tuple
+    """
+    genome_list = os.path.join(work_dir, 'genome_list.txt')
+    with open(genome_list, 'w') as list_out:
+        for name in sorted(genome_files):
+            list_out.write(name + '\t' + genome_files[name] + '\n')
+
+    bin_dir = os.path.join(work_dir, 'bin')
+    install_fake_blast(bin_dir)
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+
+    output_dir = os.path.join(work_dir, output_name)
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'ANI_blastn.py'),
+               '-i', genome_list, '-o', output_dir] + ani_options
+    with open(os.devnull, 'w') as devnull:
+        seconds, status = time_call(
+            lambda: subprocess.call(command, stdout=devnull, stderr=devnull,
+                                    env=env))
+    if status != 0:
+        print_status('ANI_blastn.py failed with status ' + str(status))
+    return seconds, output_dir
+
+
+def run_end_to_end(genome_files, args, work_dir):
+    """
+    Run ANI_blastn.py on the genome fasta files with the fake BLAST commands.
+
+    :return: Wall time of the run in seconds
+    :rtype: float
+    """
+    print_status('Running ANI_blastn.py on ' + str(len(genome_files)) +
+                 ' genomes')
+    seconds, output_dir = run_ani_blastn(
+        genome_files, work_dir, 'ani_' + str(len(genome_files)),
+        args.ani_options.split())
+    return seconds
+
+
+def check_all_vs_all(genome_files, work_dir):
+    """
+    Run ANI_blastn.py pairwise and with --all_vs_all on the same genomes, and
+    compare both matrices.
+
+    :return: Largest difference between the matrices, or NaN if a run failed
+    :rtype: float
+    """
+    print_status('Comparing the pairwise and the all vs all matrices of ' +
+                 str(len(genome_files)) + ' genomes')
+    matrices = []
+    for output_name, ani_options in (('pairwise', []),
+                                     ('all_vs_all', ['--all_vs_all'])):
+        seconds, output_dir = run_ani_blastn(
+            genome_files, work_dir, output_name,
+            ani_options + ['--no_dendrogram', '--results_store',
+                           os.path.join(work_dir, output_name + '.sqlite')])
+        matrix_file = os.path.join(output_dir, 'matrix_file.npy')
+        if not os.path.isfile(matrix_file):
+            return float('nan')
+        matrices.append(np.load(matrix_file))
+
+    difference = float(np.abs(matrices[0] - matrices[1]).max())
+    if difference > 0:
+        print_status('The all vs all matrix differs from the pairwise matrix '
+                     'by up to ' + str(difference))
+    return difference
+
+
+def git_commit():
+    """
+    Return the git commit of the repository, or 'unknown'.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                stderr=devnull)
+        return commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def previous_record(history_file, record):
+    """
+    Return the last record of the history with the same scale and
+    parameters, or None.
+    """
+    if not os.path.isfile(history_file):
+        return None
+    previous = None
+    with open(history_file, 'r') as f:
+        for l in f:
+            old_record = json.loads(l)
+            if old_record['genomes'] == record['genomes'] and \
+                    old_record['parameters'] == record['parameters']:
+                previous = old_record
+    return previous
+
+
+###############################################################################
+# ARGUMENT PARSING
+###############################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Python side '
+                                     'of ANI_blastn.py with synthetic '
+                                     'genomes and a BLAST stand-in')
+    parser.add_argument('-s', '--scales', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='Numbers of genomes to benchmark')
+    parser.add_argument('-o', '--output_directory',
+                        default='ANI_benchmark_output',
+                        help='Directory for the work files and the history')
+    parser.add_argument('--history', help='History file of the benchmarks '
+                        '(default: output_directory/benchmark_history.jsonl)')
+    parser.add_argument('--genome_length', type=int, default=20000,
+                        help='Length of each synthetic genome')
+    parser.add_argument('--contigs', type=int, default=3,
+                        help='Number of contigs of each genome')
+    parser.add_argument('--families', type=int, default=5,
+                        help='Number of genome families')
+    parser.add_argument('--family_divergence', type=float, default=0.15,
+                        help='Substitution rate between the families and '
+                        'the ancestor')
+    parser.add_argument('--member_divergence', type=float, default=0.03,
+                        help='Largest substitution rate between a genome '
+                        'and its family')
+    parser.add_argument('--fragment_size', type=int, default=500,
+                        help='Size of the query fragments')
+    parser.add_argument('--max_pairs', type=int, default=20,
+                        help='Pairs sampled to time the top hits and ANI')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the synthetic genomes and the sample')
+    parser.add_argument('--end_to_end', action='store_true',
+                        help='Also time full ANI_blastn.py runs with the '
+                        'BLAST stand-in')
+    parser.add_argument('--end_to_end_max', type=int, default=10,
+                        help='Largest scale for the full runs')
+    parser.add_argument('--check_all_vs_all', action='store_true',
+                        help='Also check that ANI_blastn.py --all_vs_all '
+                        'gives the same matrix as the pairwise run, with the '
+                        'BLAST stand-in, up to --end_to_end_max genomes')
+    parser.add_argument('--ani_options', default='',
+                        help='Options added to the ANI_blastn.py runs, '
+                        'e.g. --ani_options="--vectorized --stream_blast"')
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_directory):
+        os.makedirs(args.output_directory)
+    history_file = args.history or os.path.join(args.output_directory,
+                                                'benchmark_history.jsonl')
+
+    parameters = dict((option, getattr(args, option)) for option in
+                      ('genome_length', 'contigs', 'families',
+                       'family_divergence', 'member_divergence',
+                       'fragment_size', 'max_pairs', 'seed', 'ani_options'))
+    commit = git_commit()
+
+    ###########################################################################
+    # BEGIN PROCESSING
+    ###########################################################################
+    all_vs_all_differs = False
+    for n_genomes in args.scales:
+        work_dir = os.path.join(args.output_directory,
+                                'genomes_' + str(n_genomes))
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+        record = {'commit': commit, 'date': timestamp().strip('[]'),
+                  'genomes': n_genomes, 'parameters': parameters,
+                  'results': benchmark_scale(n_genomes, args, work_dir)}
+        previous = previous_record(history_file, record)
+
+        with open(history_file, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+        # Print the results, next to the last run with the same parameters
+        print('# {} genomes, commit {}'.format(n_genomes, commit))
+        if previous:
+            print('measure', 'value', 'previous (' + previous['commit'] + ')',
+                  'ratio', sep='\t')
+        else:
+            print('measure', 'value', sep='\t')
+        for measure in sorted(record['results']):
+            value = record['results'][measure]
+            if previous and measure in previous['results']:
+                old_value = previous['results'][measure]
+                ratio = value / old_value if old_value else float('nan')
+                print(measure, '%.6g' % value, '%.6g' % old_value,
+                      '%.3f' % ratio, sep='\t')
+            else:
+                print(measure, '%.6g' % value, sep='\t')
+        sys.stdout.flush()
+
+        # NaN when a run failed, which is not 0 either
+        if record['results'].get('all_vs_all_max_difference', 0) != 0:
+            all_vs_all_differs = True
+
+    if all_vs_all_differs:
+        sys.exit('The all vs all and the pairwise matrices differ')
+    print_status('Benchmark complete!')
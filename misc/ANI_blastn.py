@@ -4,80 +4,391 @@
 #    https://github.com/juanu/ANI_analysis/blob/master/ANI_blastn.py
 #
 #Created on 4/2/2013
+from __future__ import print_function
 __author__ = 'Juan A. Ugalde'
 
+from collections import namedtuple
+from contextlib import contextmanager
 
-def split_sequence_fragments(sequence, block_size):
+#Statistics of a genome, collected when the genome is fragmented
+GenomeStats = namedtuple("GenomeStats", ["genome_size", "trimmed_genome_size", "contigs", "fragments"])
+
+#Parameters for blastn, shared by the runs that write a file and the runs that stream the results
+BLASTN_PARAMETERS = ["-xdrop_gap", "150", "-penalty", "-1", "-dust", "no", "-outfmt", "6",
+                     "-gapopen", "5", "-gapextend", "2"]
+
+
+class StageTimer(object):
+    """
+    Measure the stages of a task: the wall time, the CPU time of the process and of its
+    finished child processes (like blastn), the peak resident memory (in KB) of the process
+    during the stage, and the largest peak of the child processes of the stage that were
+    waited for with StageTimer.wait_child. Peaks are measured on Linux, from /proc: the
+    high-water mark of the process is reset at the start of each stage, and the one of each
+    child is read while it runs. Elsewhere the peak of the process is None.
+    The record is a dictionary with the task description and the list of stages, ready to be
+    returned from a process pool and saved as JSON
+    """
+    #Largest peak memory of the child processes of the current stage
+    child_peak_rss = None
+
+    def __init__(self, **task_description):
+        self.record = dict(task_description, stages=[])
+
+    @staticmethod
+    def cpu_time():
+        import resource
+
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+    @staticmethod
+    def reset_peak_rss():
+        """
+        Reset the high-water mark of the resident memory of the process (Linux only).
+        Returns False if it can not be reset
+        """
+        try:
+            with open("/proc/self/clear_refs", 'w') as clear_refs:
+                clear_refs.write("5")
+        except (IOError, OSError):
+            return False
+        return True
+
+    @staticmethod
+    def peak_rss(status_file="/proc/self/status"):
+        """
+        Returns the high-water mark of the resident memory of a process in KB, or None if the
+        process has exited
+        """
+        with open(status_file) as process_status:
+            for line in process_status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+        return None
+
+    @classmethod
+    def sample_child(cls, pid):
+        """
+        Keep the high-water mark of a running child process. The mark starts again when the
+        child runs its program, so unlike the ru_maxrss of os.wait4 it does not include the
+        memory of this process at the time of the fork
+        """
+        try:
+            child_peak = cls.peak_rss("/proc/%d/status" % pid)
+        except (IOError, OSError):
+            return
+        if child_peak is not None:
+            cls.child_peak_rss = max(cls.child_peak_rss or 0, child_peak)
+
+    @classmethod
+    def wait_child(cls, process, poll_interval=0.02):
+        """
+        Wait for a subprocess.Popen process, sampling its peak resident memory until it exits.
+        Without /proc, the ru_maxrss of os.wait4 is used instead. Returns the exit code, like
+        Popen.wait
+        """
+        import os
+        import time
+
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            cls.sample_child(process.pid)
+            time.sleep(poll_interval)
+
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+
+        if not os.path.isdir("/proc/self"):
+            cls.child_peak_rss = max(cls.child_peak_rss or 0, usage.ru_maxrss)
+        return process.returncode
+
+    @contextmanager
+    def stage(self, stage_name):
+        import time
+
+        StageTimer.child_peak_rss = None
+        peak_reset = self.reset_peak_rss()
+        start_wall = time.time()
+        start_cpu = self.cpu_time()
+        try:
+            yield
+        finally:
+            self.record["stages"].append({"stage": stage_name, "wall": time.time() - start_wall,
+                                          "cpu": self.cpu_time() - start_cpu,
+                                          "peak_rss_kb": self.peak_rss() if peak_reset else None,
+                                          "child_peak_rss_kb": StageTimer.child_peak_rss})
+
+
+def run_command(command):
+    """
+    Run a command, given as a list of arguments, and wait for it with StageTimer.wait_child so
+    its peak memory is measured. Returns the exit code, 127 if the command is not found like
+    in a shell
+    """
+    import subprocess
+
+    try:
+        process = subprocess.Popen(command)
+    except OSError:
+        return 127
+    return StageTimer.wait_child(process)
+
+
+def write_timing_record(timing_output, timing_summary, timing_record):
+    """
+    Save a StageTimer record as a line of JSON, and add its stages to the summary of the
+    run: the number of times, wall time, CPU time and largest peak memory of the process and
+    of the child processes of each stage
+    """
+    import json
+
+    timing_output.write(json.dumps(timing_record, sort_keys=True) + "\n")
+
+    for stage in timing_record["stages"]:
+        stage_summary = timing_summary.setdefault(stage["stage"], [0, 0.0, 0.0, None, None])
+        stage_summary[0] += 1
+        stage_summary[1] += stage["wall"]
+        stage_summary[2] += stage["cpu"]
+        #Peaks are None when they were not measured
+        for summary_index, peak_name in ((3, "peak_rss_kb"), (4, "child_peak_rss_kb")):
+            if stage.get(peak_name) is not None:
+                stage_summary[summary_index] = max(stage_summary[summary_index] or 0, stage[peak_name])
+
+
+def write_timing_report(timing_summary, report_file):
+    """
+    Write the summary of the stages of the run, with the share of the wall time of each stage.
+    The stages of the pairs that run at the same time overlap, so the sum of their wall times
+    is larger than the time of the run
+    """
+    total_wall = sum(stage_summary[1] for stage_summary in timing_summary.values()) or 1.0
+
+    timing_report = open(report_file, 'w')
+    timing_report.write("Stage\tCount\tWall time (s)\tMean wall time (s)\tShare of wall time (%)\t"
+                        "CPU time (s)\tCPU / wall\tMax peak RSS (KB)\tMax child peak RSS (KB)\n")
+
+    for stage_name in sorted(timing_summary, key=lambda name: -timing_summary[name][1]):
+        count, wall, cpu, peak_rss, child_peak_rss = timing_summary[stage_name]
+        timing_report.write("%s\t%d\t%.3f\t%.3f\t%.1f\t%.3f\t%.2f\t%s\t%s\n" %
+                            (stage_name, count, wall, wall / count, 100 * wall / total_wall, cpu,
+                             cpu / wall if wall > 0 else 0.0, "NA" if peak_rss is None else peak_rss,
+                             "NA" if child_peak_rss is None else child_peak_rss))
+
+    timing_report.close()
+
+
+def iter_sequence_fragments(sequence, block_size):
     """
-    Function that takes a sequence of letters (usually a DNA sequence), and returns
-    fragments of a defined block size
+    Function that takes a sequence of letters (usually a DNA sequence) as bytes or a
+    bytearray, and yields fragments of a defined block size. The fragments are memoryview
+    slices of the sequence, so they are not copied
     """
-    fragments = []
-    total_size = len(sequence)
+    sequence_view = memoryview(sequence)
 
-    for i in range(0, total_size, block_size):
-        fragments.append(sequence[i:i + block_size])
+    for i in range(0, len(sequence_view), block_size):
+        yield sequence_view[i:i + block_size]
 
-    return fragments
 
+def read_fasta_contigs(fasta_file):
+    """
+    Read a fasta file one contig at a time, removing the Ns as each line is read, so only
+    one copy of the contig is kept in memory. Yields the contig without Ns, as a bytearray,
+    and the size of the contig
+    """
+    contig_sequence = None
+    contig_size = 0
+
+    with open(fasta_file, 'rb') as fasta_handle:
+        for fasta_line in fasta_handle:
+            if fasta_line.startswith(b">"):
+                if contig_sequence is not None:
+                    yield contig_sequence, contig_size
+                contig_sequence = bytearray()
+                contig_size = 0
+                continue
+
+            if contig_sequence is None:  # Text before the first header
+                continue
+
+            fasta_line = b"".join(fasta_line.split())
+            contig_size += len(fasta_line)
+            contig_sequence.extend(fasta_line.replace(b"N", b""))
+
+    if contig_sequence is not None:
+        yield contig_sequence, contig_size
+
+
+def genome_file_hash(genome_file):
+    """
+    Returns the SHA1 of the content of a genome fasta file, used as the key of the
+    cached files of the genome, so they are rebuilt only when the genome changes
+    """
+    import hashlib
+
+    file_hash = hashlib.sha1()
+    with open(genome_file, 'rb') as genome_handle:
+        for block in iter(lambda: genome_handle.read(1 << 20), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
 
-def run_blastn(folder, reference, query, names):
+
+def make_blast_database(reference, cache_folder, reference_hash, extra_parameters=()):
     """
-    Function that takes a reference file and a query file and run blastn.
-    The required input is a folder to create the temporal blast database, and
-    reference and query files in fasta format.
-    The results will be saved with the name of query versus reference
+    Build the blast database of the reference inside the cache folder, in a folder named
+    with the hash of the reference. If the database is already in the cache it is reused.
+    The database is built in a temporal folder that is renamed when complete, so an
+    interrupted build or several processes building the same database are safe.
+    extra_parameters are added to the makeblastdb command.
+    Returns the path of the database
     """
     import os
-    #Make blastdb
+    import shutil
+
+    database_folder = cache_folder + "/" + reference_hash
+    database = database_folder + "/reference"
+
+    if os.path.isdir(database_folder):
+        return database
+
     if not os.path.isfile(reference):
-        print "Reference file: %s not found" % reference
+        print("Reference file: %s not found" % reference)
+
+    build_folder = "%s.%d.tmp" % (database_folder, os.getpid())
+    if os.path.exists(build_folder):
+        shutil.rmtree(build_folder)
+    os.makedirs(build_folder)
+
+    #os.system('formatdb -i %s -p F -n %s/reference' % (reference, build_folder))
+    exit_status = run_command(["makeblastdb", "-in", reference, "-dbtype", "nucl", "-out",
+                               build_folder + "/reference"] + list(extra_parameters))
+    if exit_status != 0:
+        shutil.rmtree(build_folder)
+        raise RuntimeError("makeblastdb failed for the reference file: %s" % reference)
+
+    try:
+        os.rename(build_folder, database_folder)
+    except OSError:  # Other process finished the same database first
+        if not os.path.isdir(database_folder):
+            raise
+        shutil.rmtree(build_folder)
+
+    return database
+
+
+def timed_genome_task(stage_name, function, task):
+    """
+    Run the function of a genome with the arguments of the task tuple, measured as a stage of
+    the genome. Used with functools.partial, to map the tasks with a process pool.
+    Returns the result and the StageTimer record of the genome
+    """
+    stage_timer = StageTimer(task="genome", genome_file=task[0])
+    with stage_timer.stage(stage_name):
+        result = function(*task)
+
+    return result, stage_timer.record
 
-    #os.system('formatdb -i %s -p F -n %s/reference' % (reference, folder))
-    os.system('makeblastdb -in %s -dbtype nucl -out %s/reference' % (reference, folder))
 
-    num_processors = 4  # Number of processors to use for Blast
+def run_blastn(folder, database, query, names, num_threads=4, extra_parameters=()):
+    """
+    Function that takes a blast database of the reference and a query file and run blastn.
+    The required input is a folder to save the blast results, the database made by
+    make_blast_database and a query file in fasta format.
+    The results will be saved with the name of query versus reference. If blastn fails, the
+    results it wrote are removed and an error is raised, so they are never parsed
+    """
+    import os
 
     query_name, reference_name = names
 
     blast_output_name = folder + "/" + query_name + "_" + reference_name
 
-    #os.system('blastall -p blastn -a %d -d %s/reference -i %s -X 150 -q -1 -F F -m 8 -o %s' %
-    #          (num_processors, folder, query, blast_output_name))
+    #os.system('blastall -p blastn -a %d -d %s -i %s -X 150 -q -1 -F F -m 8 -o %s' %
+    #          (num_threads, database, query, blast_output_name))
 
-    os.system('blastn -num_threads %d -db %s/reference -query %s -xdrop_gap 150  -penalty -1 -dust no -outfmt 6 '
-              '-gapopen 5 -gapextend 2 -out %s' %
-    (num_processors, folder, query, blast_output_name))
+    exit_status = run_command(["blastn", "-num_threads", str(num_threads), "-db", database, "-query", query] +
+                              BLASTN_PARAMETERS + list(extra_parameters) + ["-out", blast_output_name])
+    if exit_status != 0:
+        if os.path.isfile(blast_output_name):
+            os.remove(blast_output_name)
+        raise RuntimeError("blastn failed for the query %s against %s" % (query, database))
 
     return blast_output_name
 
 
-def get_blast_top_hit(blast_file):
+def stream_blastn(database, query, num_threads=4, extra_parameters=()):
     """
-    Parse the blast file. Select the top hit
+    Run blastn with the same parameters as run_blastn, but read the results from a pipe
+    instead of a file. Yields each line of the blast results
+    """
+    import subprocess
+
+    blast_command = ["blastn", "-num_threads", str(num_threads), "-db", database, "-query", query] + \
+        BLASTN_PARAMETERS + list(extra_parameters)
+    blast_process = subprocess.Popen(blast_command, stdout=subprocess.PIPE, bufsize=1 << 16,
+                                     universal_newlines=True)
+
+    #blastn is still running while its results are read, sample its memory every 1000 lines
+    for line_number, blast_line in enumerate(blast_process.stdout):
+        if line_number % 1000 == 0:
+            StageTimer.sample_child(blast_process.pid)
+        yield blast_line
+
+    blast_process.stdout.close()
+    if StageTimer.wait_child(blast_process) != 0:
+        raise RuntimeError("blastn failed for the query %s against %s" % (query, database))
+
+
+def typed_blast_hit(blast_fields):
+    """
+    Convert the fields of a blast hit (outfmt 6) to numbers, except the query and subject IDs
+    """
+    (queryId, subjectId, percIdentity, alnLength, mismatchCount, gapOpenCount, queryStart,
+     queryEnd, subjectStart, subjectEnd, evalue, bitScore) = blast_fields
+
+    return [queryId, subjectId, float(percIdentity), int(alnLength), int(mismatchCount), int(gapOpenCount),
+            int(queryStart), int(queryEnd), int(subjectStart), int(subjectEnd), float(evalue), float(bitScore)]
+
+
+def reduce_blast_top_hits(blast_lines):
+    """
+    Select the top hit of each query from the lines of a blast result, as they are read.
+    Only the best hit of each query is kept, with its values converted to numbers, and
+    when two hits have the same bit score the last one is kept, like get_blast_top_hit did
     """
-    blast_results = [line.rstrip() for line in open(blast_file)]
     blast_top_hit = {}
 
-    for blast_line in blast_results:
-        best_hit = True
-        (queryId, subjectId, percIdentity, alnLength, mismatchCount, gapOpenCount, queryStart,
-         queryEnd, subjectStart, subjectEnd, evalue, bitScore) = blast_line.split("\t")
+    for blast_line in blast_lines:
+        blast_fields = blast_line.rstrip("\n").split("\t")
+        queryId = blast_fields[0]
 
         #get the top hit
-        if queryId in blast_top_hit:
-            if float(bitScore) < float(blast_top_hit.get(queryId)[11]):
-                best_hit = False
+        if queryId in blast_top_hit and float(blast_fields[11]) < blast_top_hit[queryId][11]:
+            continue
 
-        if best_hit:
-            blast_top_hit[queryId] = blast_line.split("\t")
+        blast_top_hit[queryId] = typed_blast_hit(blast_fields)
 
     return blast_top_hit
 
 
-def calculate_ani(blast_results, fragment_length):
+def get_blast_top_hit(blast_file):
+    """
+    Parse the blast file. Select the top hit
+    """
+    with open(blast_file) as blast_results:
+        return reduce_blast_top_hits(blast_results)
+
+
+def calculate_ani(blast_results, fragment_length, exact_fragments=()):
     """
-    Takes the input of the blast results, and calculates the ANI versus the reference genome
+    Takes the input of the blast results, and calculates the ANI versus the reference genome.
+    The exact fragments, found in the reference before blast, have 100% identity over their full length
     """
     sum_identity = float(0)
     number_hits = 0  # Number of hits that passed the criteria
@@ -87,6 +398,12 @@ def calculate_ani(blast_results, fragment_length):
 
     conserved_dna_bases = 0
 
+    for query in exact_fragments:
+        sum_identity += 100.0
+        number_hits += 1
+        total_aligned_bases += fragment_length[query]
+        conserved_dna_bases += fragment_length[query]
+
     for query in blast_results:
         identity = blast_results[query][2]
         queryEnd = blast_results[query][7]
@@ -109,223 +426,1998 @@ def calculate_ani(blast_results, fragment_length):
     return sum_identity, number_hits, total_aligned_bases, total_unaligned_fragments, total_unaligned_bases
 
 
-def average_ani_results(ani_dictionary):
+def read_blast_top_hit_arrays(blast_lines, number_fragments, batch_size=100000):
     """
-    This function takes the dictionary that contains the ani dictionary, take the reference and query
-    and takes the average between the two results of the combination of reference and query
+    Select the top hit of each fragment from the lines of a blast result, reading them
+    in batches that are parsed with numpy. The top hits are kept as column arrays indexed
+    by fragment (Fragment1 is at index 0). When two hits have the same bit score the last
+    one is kept, like get_blast_top_hit.
+    Returns the identity, query start and query end of the top hits, and a boolean array
+    with the fragments that have a hit
     """
-    refined_ani_results = {}
+    from itertools import islice
+    import numpy as np
 
-    for pair in ani_dictionary:
-        reference_query_value = ani_dictionary[pair]
-        reference, query = pair
-        query_reference_value = ani_dictionary[(query, reference)]
+    best_bit_score = np.full(number_fragments, -np.inf)
+    identity = np.zeros(number_fragments)
+    query_start = np.zeros(number_fragments)
+    query_end = np.zeros(number_fragments)
 
-        average_value = (reference_query_value + query_reference_value) / 2
+    prefix_length = len("Fragment")
+    blast_lines = iter(blast_lines)
 
-        if (query, reference) in refined_ani_results:
-            continue
+    while True:
+        batch = list(islice(blast_lines, batch_size))
+        if not batch:
+            break
+
+        blast_fields = "\t".join(blast_line.rstrip("\n") for blast_line in batch).split("\t")
+        batch_fragment = np.array([int(query_id[prefix_length:]) - 1 for query_id in blast_fields[0::12]])
+        batch_bit_score = np.array(blast_fields[11::12], dtype=float)
+
+        #Top hit of each fragment in the batch: order by fragment, bit score and line, and keep the last of each fragment
+        order = np.lexsort((np.arange(len(batch)), batch_bit_score, batch_fragment))
+        sorted_fragment = batch_fragment[order]
+        last_of_fragment = np.append(sorted_fragment[1:] != sorted_fragment[:-1], True)
+        top = order[last_of_fragment]
+
+        #Replace the top hits of the previous batches that have a lower or equal bit score
+        top = top[batch_bit_score[top] >= best_bit_score[batch_fragment[top]]]
+        top_fragment = batch_fragment[top]
+
+        best_bit_score[top_fragment] = batch_bit_score[top]
+        identity[top_fragment] = np.array(blast_fields[2::12], dtype=float)[top]
+        query_start[top_fragment] = np.array(blast_fields[6::12], dtype=float)[top]
+        query_end[top_fragment] = np.array(blast_fields[7::12], dtype=float)[top]
+
+    has_hit = best_bit_score > -np.inf
+
+    return identity, query_start, query_end, has_hit
+
+
+def calculate_ani_arrays(identity, query_start, query_end, has_hit, fragment_lengths):
+    """
+    Vectorized version of calculate_ani, over the top hit arrays of read_blast_top_hit_arrays
+    and an array with the length of each fragment. Returns the same values as calculate_ani,
+    followed by the number of bases in fragments with more than 90% identity
+    """
+    import numpy as np
+
+    identity = identity[has_hit]
+    hit_lengths = np.asarray(fragment_lengths, dtype=np.int64)[has_hit]
+
+    perc_aln_length = (query_end[has_hit] - query_start[has_hit]) / hit_lengths
+    passed = (identity > 69.9999) & (perc_aln_length > 0.69999)
+
+    sum_identity = float(identity[passed].sum())
+    number_hits = int(passed.sum())
+    total_aligned_bases = int(hit_lengths[passed].sum())
+    total_unaligned_fragments = len(passed) - number_hits
+    total_unaligned_bases = int(hit_lengths.sum()) - total_aligned_bases
+
+    conserved_dna_bases = int(hit_lengths[identity > 89.999].sum())
+
+    return (sum_identity, number_hits, total_aligned_bases, total_unaligned_fragments, total_unaligned_bases,
+            conserved_dna_bases)
+
+
+def one_directional_pairs(genome_names, genome_stats):
+    """
+    Takes the genome names and their GenomeStats, and yields one (reference, query) pair for
+    each unordered pair of genomes, with the smaller genome, without Ns, as the query
+    """
+    from itertools import combinations
+
+    for first, second in combinations(genome_names, 2):
+        if genome_stats[second].trimmed_genome_size <= genome_stats[first].trimmed_genome_size:
+            yield first, second
+        else:
+            yield second, first
+
+
+class SpeciesClusters(object):
+    """
+    Single linkage clusters of the genomes at an ANI cutoff, built with a union-find as the
+    results of the pairs arrive, without a matrix. When both directions of a pair are computed,
+    the first one is kept until the second arrives, and the clusters use their average like the
+    matrix does. The first direction is not kept if its genomes are already in the same cluster,
+    or if the average could not reach the cutoff even with an ANI of 100 for the other one
+    """
+    def __init__(self, genome_names, ani_cutoff):
+        self.ani_cutoff = ani_cutoff
+        self.parent = {genome: genome for genome in genome_names}
+        self.size = {genome: 1 for genome in genome_names}
+        self.first_halves = {}
+
+    def find(self, genome):
+        #Path halving, each genome on the path points to its grandparent
+        while self.parent[genome] != genome:
+            self.parent[genome] = self.parent[self.parent[genome]]
+            genome = self.parent[genome]
+        return genome
+
+    def union(self, first_genome, second_genome):
+        first_root, second_root = self.find(first_genome), self.find(second_genome)
+        if first_root == second_root:
+            return
+        if self.size[first_root] < self.size[second_root]:
+            first_root, second_root = second_root, first_root
+        self.parent[second_root] = first_root
+        self.size[first_root] += self.size[second_root]
+
+    def add_ani(self, genome_pair, ani):
+        """
+        Add the ANI of a pair computed in a single direction, or already averaged
+        """
+        if ani >= self.ani_cutoff:
+            self.union(*genome_pair)
+
+    def add_half(self, genome_pair, ani, first_half):
+        """
+        Add the ANI of one direction of a pair. first_half tells if the other direction
+        comes later, which is known from the order of the pairs
+        """
+        reference, query = genome_pair
+        if first_half:
+            if ani >= 2 * self.ani_cutoff - 100 and self.find(reference) != self.find(query):
+                self.first_halves[genome_pair] = ani
         else:
-            refined_ani_results[pair] = average_value
+            first_ani = self.first_halves.pop((query, reference), None)
+            if first_ani is not None:
+                self.add_ani(genome_pair, (first_ani + ani) / 2)
+
+    def clusters(self):
+        """
+        Returns the clusters as sorted lists of genomes, the largest clusters first
+        """
+        cluster_members = {}
+        for genome in self.parent:
+            cluster_members.setdefault(self.find(genome), []).append(genome)
 
-    return refined_ani_results
+        return sorted((sorted(members) for members in cluster_members.values()), key=lambda c: (-len(c), c[0]))
 
 
-def create_distance_matrix(ani_dictionary):
+def write_clusters(clusters_file, clusters, ani_cutoff):
     """
+    Write the genomes of each cluster, numbered from the largest, with the size of the cluster
+    """
+    with open(clusters_file, 'w') as clusters_output:
+        clusters_output.write("Genome\tCluster (ANI >= %s)\tCluster size\n" % ani_cutoff)
+        for cluster_number, members in enumerate(clusters, 1):
+            for genome in members:
+                clusters_output.write("%s\t%d\t%d\n" % (genome, cluster_number, len(members)))
+
 
+def create_distance_matrix(genome_names, matrix_file=None):
+    """
+    Takes the genome names and returns an empty float32 matrix for the distances (100 - ANI),
+    to be filled with add_pair_distance as the pairs arrive. If matrix_file is given, the matrix
+    is a memory map of a .npy file, written as it is filled, instead of an array in memory.
+    Returns the index of the rows, the index of the columns and the matrix
     """
     from itertools import count
     import numpy as np
 
-    data = []
-    for pair in ani_dictionary:
-        reference, query = pair
-        value = 100 - float(ani_dictionary[pair])
-        data.append([reference, query, value])
-        data.append([query, reference, value])
+    rows = dict(zip(genome_names, count()))
+    cols = rows
 
-    rows = dict(zip(sorted(set(line[0] for line in data)), count()))
-    cols = dict(zip(sorted(set(line[1] for line in data)), count()))
+    matrix_shape = (len(rows), len(rows))
+    if matrix_file is None:
+        ani_array = np.zeros(matrix_shape, dtype=np.float32)
+    else:
+        ani_array = np.lib.format.open_memmap(matrix_file, mode="w+", dtype=np.float32, shape=matrix_shape)
+        ani_array[:] = 0
 
-    ani_array = np.zeros((len(rows), len(rows)), dtype=float)
+    return rows, cols, ani_array
 
-    for row, col, val in data:
-        index = (rows[row], cols[col])
-        ani_array[index] = val
 
-    return rows, cols, ani_array
+def add_pair_distance(ani_array, rows, genome_pair, ani, both_directions):
+    """
+    Add the ANI of a pair to the distance matrix of create_distance_matrix. When both directions
+    of the pair are computed, each one adds half of its distance to both halves of the matrix,
+    so they end with the average of both. A pair computed in a single direction sets both
+    """
+    reference, query = genome_pair
+    row, col = rows[reference], rows[query]
 
+    if both_directions:
+        half_distance = (100 - float(ani)) / 2
+        ani_array[row, col] += half_distance
+        ani_array[col, row] += half_distance
+    else:
+        ani_array[row, col] = ani_array[col, row] = 100 - float(ani)
 
-if __name__ == '__main__':
-    import sys
-    import shutil
-    import argparse
+
+def write_matrix_file(matrix_file, genome_names, ani_array, corner_label="", float_format="%.9g"):
+    """
+    Write the matrix as a table with the genome names, formatting each row with a single
+    format string instead of a str() for each value. The default format has the 9 significant
+    digits that read back to the same float32, so the table is as precise as the .npy.
+    The corner label goes in the first cell
+    """
+    row_format = "\t".join([float_format] * len(genome_names)) + "\n"
+
+    with open(matrix_file, 'w') as matrix_output:
+        matrix_output.write(corner_label + "\t" + "\t".join(genome_names) + "\n")
+        for genome, row in zip(genome_names, ani_array):
+            matrix_output.write(genome + "\t" + row_format % tuple(row.tolist()))
+
+
+def write_query_fragments(query_file, fragments_file, fragment_size):
+    """
+    Split every contig of the query genome (with the Ns removed) in fragments of
+    fragment_size and write them to fragments_file, named Fragment1, Fragment2...
+    The fragments are written from the contig as it is read, without copies, through a
+    large write buffer.
+    Returns an array with the length of each fragment, in the order of the names,
+    and the GenomeStats of the genome, all from the same pass over the fasta
+    """
+    from array import array
+
+    query_fragments_file = open(fragments_file, 'wb', 1 << 22)
+
+    fragment_number = 1  # Id of each fragment
+    fragment_lengths = array('I')  # Store the size of each fragment
+    complete_query_genome_size = 0  # Total size of the query genome
+    trimmed_query_genome_size = 0  # Total size of genome no Ns
+    query_contigs = 0
+
+    for edited_genome_sequence, contig_size in read_fasta_contigs(query_file):
+        complete_query_genome_size += contig_size
+        trimmed_query_genome_size += len(edited_genome_sequence)
+        query_contigs += 1
+
+        for fragment in iter_sequence_fragments(edited_genome_sequence, fragment_size):
+
+            query_fragments_file.write(b">Fragment" + str(fragment_number).encode("ascii") + b"\n")
+            query_fragments_file.write(fragment)
+            query_fragments_file.write(b"\n")
+
+            fragment_lengths.append(len(fragment))
+
+            fragment_number += 1
+
+    query_fragments_file.close()
+
+    query_stats = GenomeStats(complete_query_genome_size, trimmed_query_genome_size, query_contigs,
+                              len(fragment_lengths))
+
+    return fragment_lengths, query_stats
+
+
+def make_query_fragments(query_file, cache_folder, query_hash, fragment_size):
+    """
+    Fragment the query genome once and keep the fragments in the cache folder, named
+    with the hash of the genome and the fragment size:
+    <prefix>.fna with the fragments, <prefix>.len with the fragment lengths as 32 bit
+    integers and <prefix>.stats with the GenomeStats of the genome. The .stats file is
+    written last, so only complete fragment sets are reused.
+    Returns the prefix of the files, to use with load_query_fragments and load_genome_stats
+    """
     import os
-    import itertools
+
+    fragments_prefix = "%s/%s_%d" % (cache_folder, query_hash, fragment_size)
+
+    if os.path.isfile(fragments_prefix + ".stats"):
+        return fragments_prefix
+
+    temporal_prefix = "%s.%d.tmp" % (fragments_prefix, os.getpid())
+    fragment_lengths, query_stats = write_query_fragments(query_file, temporal_prefix + ".fna", fragment_size)
+
+    with open(temporal_prefix + ".len", 'wb') as lengths_file:
+        fragment_lengths.tofile(lengths_file)
+
+    with open(temporal_prefix + ".stats", 'w') as stats_file:
+        stats_file.write("\t".join(str(value) for value in query_stats) + "\n")
+
+    for extension in (".fna", ".len", ".stats"):
+        os.rename(temporal_prefix + extension, fragments_prefix + extension)
+
+    return fragments_prefix
+
+
+def load_query_fragments(fragments_prefix):
+    """
+    Read the fragment set saved by make_query_fragments.
+    Returns the fasta file of the fragments and an array with the length of each fragment
+    """
+    import os
+    from array import array
+
+    fragment_lengths = array('I')
+    number_fragments = os.path.getsize(fragments_prefix + ".len") // fragment_lengths.itemsize
+    with open(fragments_prefix + ".len", 'rb') as lengths_file:
+        fragment_lengths.fromfile(lengths_file, number_fragments)
+
+    return fragments_prefix + ".fna", fragment_lengths
+
+
+def load_genome_stats(fragments_prefix):
+    """
+    Read the GenomeStats saved by make_query_fragments
+    """
+    with open(fragments_prefix + ".stats") as stats_file:
+        return GenomeStats(*[int(value) for value in stats_file.read().split("\t")])
+
+
+def kmer_codes(sequence, kmer_size, return_positions=False):
+    """
+    Returns the canonical k-mers of a DNA sequence as 2 bit encoded integers (kmer_size
+    up to 32), the smaller of the k-mer and its reverse complement. K-mers with bases
+    other than A, C, G or T are left out. With return_positions, the start of each k-mer
+    in the sequence is returned too
+    """
+    import numpy as np
+
+    if not isinstance(sequence, bytes):
+        sequence = sequence.encode("ascii")
+
+    base_codes = np.full(256, 4, dtype=np.uint8)
+    for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+        for base in bases:
+            base_codes[ord(base)] = code
+
+    codes = base_codes[np.frombuffer(sequence, dtype=np.uint8)]
+    number_kmers = len(codes) - kmer_size + 1
+    if number_kmers <= 0:
+        if return_positions:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.intp)
+        return np.zeros(0, dtype=np.uint64)
+
+    #K-mers that contain a base that is not A, C, G or T
+    invalid_bases = np.concatenate(([0], np.cumsum(codes == 4)))
+    invalid_kmers = (invalid_bases[kmer_size:] - invalid_bases[:-kmer_size]) > 0
+
+    codes = (codes & 3).astype(np.uint64)
+    forward = np.zeros(number_kmers, dtype=np.uint64)
+    reverse = np.zeros(number_kmers, dtype=np.uint64)
+    for position in range(kmer_size):
+        window = codes[position:position + number_kmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * position)
+
+    if return_positions:
+        return np.minimum(forward, reverse)[~invalid_kmers], np.flatnonzero(~invalid_kmers)
+    return np.minimum(forward, reverse)[~invalid_kmers]
+
+
+def hash_kmer_codes(codes):
+    """
+    Mix the bits of the k-mer codes (splitmix64 finalizer), so the smallest hashes are a
+    random sample of the k-mers
+    """
+    import numpy as np
+
+    with np.errstate(over="ignore"):
+        hashes = codes ^ (codes >> np.uint64(30))
+        hashes = hashes * np.uint64(0xbf58476d1ce4e5b9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes = hashes * np.uint64(0x94d049bb133111eb)
+        hashes ^= hashes >> np.uint64(31)
+
+    return hashes
+
+
+def make_genome_sketch(genome_file, cache_folder, genome_hash, kmer_size, sketch_size):
+    """
+    Build the MinHash sketch of the genome: the sketch_size smallest hashes of its
+    canonical k-mers. The sketch is saved in the cache folder, named with the hash of
+    the genome and the sketch parameters, and reused when it is already there.
+    Returns the path of the sketch
+    """
+    import os
+    import numpy as np
     from Bio import SeqIO
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    import scipy.cluster.hierarchy as sch
-    import scipy.spatial.distance
 
-    program_description = "Script that takes a list of genomes, containing the location of the fasta files," \
-                          "and generates a matrix with the ANI values for all the combinations"
+    sketch_file = "%s/%s_k%d_s%d.npy" % (cache_folder, genome_hash, kmer_size, sketch_size)
 
-    parser = argparse.ArgumentParser(description=program_description)
+    if os.path.isfile(sketch_file):
+        return sketch_file
 
-    parser.add_argument("-i", "--genome_input_list", type=str, help="List with the genome names and files",
-                        required=True)
+    sketch = np.zeros(0, dtype=np.uint64)
+    for seq_record in SeqIO.parse(genome_file, "fasta"):
+        contig_hashes = hash_kmer_codes(kmer_codes(str(seq_record.seq), kmer_size))
+        sketch = np.unique(np.concatenate((sketch, contig_hashes)))[:sketch_size]
 
-    parser.add_argument("-o", "--output_directory", type=str, help="Output directory", required=True)
+    temporal_file = "%s.%d.tmp.npy" % (sketch_file[:-len(".npy")], os.getpid())
+    np.save(temporal_file, sketch)
+    os.rename(temporal_file, sketch_file)
 
-    args = parser.parse_args()
+    return sketch_file
 
-    #Create output directory
-    if not os.path.exists(args.output_directory):
-        os.makedirs(args.output_directory)
 
-    #Create temporal folder for the blast analysis
-    temp_folder = args.output_directory + "/temp"
-    if not os.path.exists(temp_folder):
-        os.makedirs(temp_folder)
+def sketch_distance(reference_sketch, query_sketch, kmer_size, sketch_size):
+    """
+    Estimate the Mash distance between two genomes from their sketches. The Jaccard index
+    is the fraction of the smallest hashes of both sketches together that are in both.
+    Returns the distance and the estimated ANI (100 * (1 - distance)), both None when the
+    sketches share no hash: the ANI is then below the detection limit of the sketches
+    """
+    import math
+    import numpy as np
 
-    #Read the genome list:
-    genome_info = {element[0]: element[1] for element in [line.split("\t") for line in [line.rstrip() for line in open(args.genome_input_list)] if line.strip()]}
+    union_sketch = np.union1d(reference_sketch, query_sketch)[:sketch_size]
+    shared_hashes = np.intersect1d(np.intersect1d(reference_sketch, query_sketch), union_sketch)
 
-    #Create log file
-    log_output = open(args.output_directory + "/logfile.txt", 'w')
-    mapping_summary = open(args.output_directory + "/mapping_summary.txt", 'w')
+    if len(union_sketch) == 0 or len(shared_hashes) == 0:
+        return None, None
 
-    mapping_summary.write("Reference\tReference Genome size\t"
-                          "Query\tQuery Genome Size\t"
-                          "Total number fragments\tMapped Fragments\tIdentity\t"
-                          "Mapped Bases\tUnmapped fragments\tUnmapped Bases\n")
+    jaccard = float(len(shared_hashes)) / len(union_sketch)
+    distance = min(1.0, -math.log(2 * jaccard / (1 + jaccard)) / kmer_size)
 
-    #Parameters for blast and fragments
-    fragment_size = 500
+    return distance, 100 * (1 - distance)
 
-    #Create genome combinations for blast analysis
-    genome_combinations = itertools.permutations(genome_info.keys(), 2)
-    genome_pair_identity = {}  # Results
 
-    raw_ani_results = {}  # Results of the ANI analysis
+def sketch_detection_limit(kmer_size, sketch_size):
+    """
+    Returns the lowest ANI that the sketches can estimate, with a single shared hash out of
+    sketch_size. Pairs that share no hash have a lower ANI
+    """
+    import math
 
-    for genome_pair in genome_combinations:
-        reference, query = genome_pair[0], genome_pair[1]
+    jaccard = 1.0 / sketch_size
+    return 100 * (1 - min(1.0, -math.log(2 * jaccard / (1 + jaccard)) / kmer_size))
 
-        reference_file = genome_info[reference]
-        query_file = genome_info[query]
 
-        #Check that the files exists
-        if not os.path.isfile(reference_file):
-            print "The reference fasta for %s was not found" % reference
-            sys.exit("Check the path for the files")
+def make_kmer_index(genome_file, cache_folder, genome_hash, kmer_size):
+    """
+    Build the k-mer index of a reference genome for the k-mer backend: the sorted, unique
+    canonical k-mers of all its contigs. The index is saved in the cache folder, named with
+    the hash of the genome and the k-mer size, and reused when it is already there.
+    Returns the path of the index
+    """
+    import os
+    import numpy as np
+    from Bio import SeqIO
 
-        if not os.path.isfile(query_file):
-            print "The query fasta for %s was not found" % query
-            sys.exit("Check the path for the files")
+    index_file = "%s/%s_k%d_index.npy" % (cache_folder, genome_hash, kmer_size)
 
-        #Create query file, with fragments of 500bp
+    if os.path.isfile(index_file):
+        return index_file
 
-        query_fragments_file = open(temp_folder + "/query.fna", 'w')
+    contig_codes = [kmer_codes(str(seq_record.seq), kmer_size) for seq_record in SeqIO.parse(genome_file, "fasta")]
+    kmer_index = np.unique(np.concatenate(contig_codes)) if contig_codes else np.zeros(0, dtype=np.uint64)
 
-        fragment_number = 1  # Id of each fragment
-        genome_query_fragments = 0
-        fragment_length_dict = {}  # Store the size of each fragment
-        complete_query_genome_size = 0  # Total size of the query genome
-        trimmed_query_genome_size = 0  # Total size of genome no Ns
+    temporal_file = "%s.%d.tmp.npy" % (index_file[:-len(".npy")], os.getpid())
+    np.save(temporal_file, kmer_index)
+    os.rename(temporal_file, index_file)
 
-        for seq_record in SeqIO.parse(query_file, "fasta"):
-            genome_sequence = seq_record.seq
-            edited_genome_sequence = (str(genome_sequence)).replace("N", "")
+    return index_file
 
-            fragments = split_sequence_fragments(edited_genome_sequence, fragment_size)
-            complete_query_genome_size += len(seq_record.seq)
-            trimmed_query_genome_size += len(edited_genome_sequence)
 
-            genome_query_fragments += len(fragments)
+def kmer_fragment_hits(kmer_index, fragments_file, number_fragments, kmer_size):
+    """
+    Map the fragments of the query to the k-mer index of the reference, for all the fragments
+    at once: the fragments are joined with an N between them, so no k-mer crosses two of them.
+    For each fragment with a k-mer in the reference, the identity is estimated from the fraction
+    c of its k-mers found in the reference as 100 * c ** (1 / kmer_size), the probability that a
+    k-mer has no mismatch being identity ** kmer_size. The first and last found k-mers give the
+    start and end of the hit in the fragment, 1-based like blastn.
+    Returns the same arrays as read_blast_top_hit_arrays
+    """
+    import numpy as np
 
-            for fragment in fragments:
+    fragment_sequences = read_fragment_sequences(fragments_file, number_fragments)
 
-                fragment_name = "Fragment" + str(fragment_number)
-                query_fragments_file.write(">" + fragment_name + "\n" + str(fragment) + "\n")
+    fragment_starts = np.zeros(number_fragments + 1, dtype=np.int64)
+    fragment_starts[1:] = np.cumsum([len(sequence) + 1 for sequence in fragment_sequences])
 
-                fragment_length_dict[fragment_name] = len(fragment)
+    codes, positions = kmer_codes(b"N".join(fragment_sequences), kmer_size, return_positions=True)
+    fragment_numbers = np.searchsorted(fragment_starts, positions, side="right") - 1
+    positions = positions - fragment_starts[fragment_numbers]
 
-                fragment_number += 1
+    #Sorted array lookup of the k-mers in the reference
+    found = np.zeros(len(codes), dtype=bool)
+    if len(kmer_index):
+        index_positions = np.minimum(np.searchsorted(kmer_index, codes), len(kmer_index) - 1)
+        found = kmer_index[index_positions] == codes
 
-        query_fragments_file.close()
+    number_kmers = np.bincount(fragment_numbers, minlength=number_fragments)
+    found_kmers = np.bincount(fragment_numbers[found], minlength=number_fragments)
+    has_hit = found_kmers > 0
 
-        #Print total number of fragments
-        log_output.write("For the query genome: %s \n" % query)
-        log_output.write("Genome size: %d \n" % complete_query_genome_size)
-        log_output.write("Genome size, with no Ns: %d\n" % trimmed_query_genome_size)
-        log_output.write("Number of fragments: %d \n" % genome_query_fragments)
+    identity = np.zeros(number_fragments, dtype=np.float64)
+    containment = found_kmers[has_hit] / number_kmers[has_hit].astype(np.float64)
+    identity[has_hit] = 100 * containment ** (1.0 / kmer_size)
 
-        fragment_query_file = temp_folder + "/query.fna"
+    #The found k-mers are in order of fragment and position, so the first and last found k-mer
+    #of each fragment are where the fragment number changes
+    query_start = np.zeros(number_fragments, dtype=np.int64)
+    query_end = np.zeros(number_fragments, dtype=np.int64)
+    found_fragments = fragment_numbers[found]
+    found_positions = positions[found]
+    if len(found_fragments):
+        fragment_change = found_fragments[1:] != found_fragments[:-1]
+        first_found = np.concatenate(([True], fragment_change))
+        last_found = np.concatenate((fragment_change, [True]))
+        query_start[found_fragments[first_found]] = found_positions[first_found] + 1
+        query_end[found_fragments[last_found]] = found_positions[last_found] + kmer_size
 
-        #Print information to screen
-        sys.stderr.write("Running blast of %s versus %s \n" % (reference, query))
-        sys.stderr.flush()
+    return identity, query_start, query_end, has_hit
 
-        #Run blast
-        blast_file = run_blastn(temp_folder, reference_file, fragment_query_file, ("reference", "query"))
 
-        #Parse the blast result
-        blast_top_hit = get_blast_top_hit(blast_file)
+#Lowest ANI estimated by the k-mer backend, below it the fraction of found 16-mers is too small
+#and too noisy and the pair is computed with blastn
+KMER_BACKEND_MIN_ANI = 80
 
-        sum_identity, number_hits, total_aligned_bases, total_unaligned_fragments, total_unaligned_bases = \
-            calculate_ani(blast_top_hit, fragment_length_dict)
 
-        try:
-            reference_query_ani = sum_identity / number_hits
-        except ZeroDivisionError:  # Cases were there are no hits
-            reference_query_ani = 0
+def run_genome_pair_kmer(pair_task):
+    """
+    Estimate the ANI of a pair with the k-mer backend, without blast. Takes a single tuple
+    so the function can be used with a process pool, and returns the same values as
+    run_genome_pair: the pair, the values of calculate_ani and the StageTimer record.
+    If the estimated ANI is below KMER_BACKEND_MIN_ANI, or no fragment is mapped, the pair is
+    computed again with blastn, building the database of the reference if it is not cached,
+    and parsed as the blastn pairs of the run, with stream_blast and vectorized
+    """
+    import sys
+    import numpy as np
 
-        #Store the results
-        raw_ani_results[(reference, query)] = reference_query_ani
+    reference, query, reference_index, query_fragments, kmer_size, reference_file, database_cache, \
+        reference_hash, work_folder, num_threads, stream_blast, vectorized = pair_task
 
-        #Get the size of the reference genome
-        reference_genome_size = 0
-        for seq_record in SeqIO.parse(reference_file, "fasta"):
-            reference_genome_size += len(seq_record.seq)
+    fragment_query_file, fragment_lengths = load_query_fragments(query_fragments)
 
-        results = [reference, str(reference_genome_size), query, str(trimmed_query_genome_size),
-                   str(genome_query_fragments), str(number_hits), str(reference_query_ani),
-                   str(total_aligned_bases), str(total_unaligned_fragments), str(total_unaligned_bases)]
+    sys.stderr.write("Running k-mer mapping of %s versus %s \n" % (reference, query))
+    sys.stderr.flush()
 
-        mapping_summary.write("\t".join(results) + "\n")
+    stage_timer = StageTimer(task="pair", reference=reference, query=query)
 
-    ##Take the average of the reference query values
+    with stage_timer.stage("k-mer mapping"):
+        identity, query_start, query_end, has_hit = kmer_fragment_hits(np.load(reference_index, mmap_mode="r"),
+                                                                       fragment_query_file, len(fragment_lengths),
+                                                                       kmer_size)
+    with stage_timer.stage("ANI calculation"):
+        ani_values = calculate_ani_arrays(identity, query_start, query_end, has_hit, fragment_lengths)[:5]
 
-    final_ani_results = average_ani_results(raw_ani_results)
+    sum_identity, number_hits = ani_values[:2]
+    if number_hits and sum_identity / number_hits >= KMER_BACKEND_MIN_ANI:
+        return (reference, query), ani_values, stage_timer.record
 
-    #Generate matrix file
-    rows, cols, ani_array = create_distance_matrix(final_ani_results)
-    order_col_labels = sorted(cols, key=cols.get)
+    #Out of the range of the k-mer backend
+    with stage_timer.stage("makeblastdb"):
+        reference_database = make_blast_database(reference_file, database_cache, reference_hash)
+    genome_pair, ani_values, blastn_record = run_genome_pair((reference, query, reference_database, query_fragments,
+                                                              work_folder, num_threads, stream_blast, vectorized,
+                                                              None))
+    stage_timer.record["stages"].extend(blastn_record["stages"])
+    stage_timer.record["blastn_fallback"] = True
 
-    #Save matrix file
-    matrix_file = open(args.output_directory + "/matrix_file.txt", 'w')
-    matrix_file.write("\t" + "\t".join(order_col_labels) + "\n")
+    return genome_pair, ani_values, stage_timer.record
 
-    for row_label, row in zip(order_col_labels, ani_array):
-        matrix_file.write(row_label + "\t" + "\t".join(str(n) for n in row) + "\n")
 
-    #Run hierarchical analysis and save the plot
+def make_exact_index(genome_file, cache_folder, genome_hash, kmer_size=32):
+    """
+    Build the index of a reference genome for the exact match pre-pass: its contigs in upper
+    case, joined with an N, and the canonical k-mers of the joined sequence with their
+    positions, sorted by k-mer. Saved in the cache folder as a .npz file, named with the hash
+    of the genome and the k-mer size, and reused when it is already there.
+    Returns the path of the index
+    """
+    import os
+    import numpy as np
+    from Bio import SeqIO
 
-    distance_matrix = scipy.spatial.distance.squareform(ani_array)
-    linkage_matrix = sch.linkage(distance_matrix, method="complete", metric="euclidean")  # Method and metric
-    X = sch.dendrogram(linkage_matrix, labels=order_col_labels, orientation="left")
+    index_file = "%s/%s_k%d_exact.npz" % (cache_folder, genome_hash, kmer_size)
 
-    plt.subplots_adjust(left=0.3)
-    plt.savefig(args.output_directory + "/ANI_hier_plot.pdf")
+    if os.path.isfile(index_file):
+        return index_file
 
-    #Close final files
-    log_output.close()
-    mapping_summary.close()
-    matrix_file.close()
+    sequence = b"N".join(str(seq_record.seq).upper().encode("ascii")
+                         for seq_record in SeqIO.parse(genome_file, "fasta"))
+    codes, positions = kmer_codes(sequence, kmer_size, return_positions=True)
+    kmer_order = np.argsort(codes, kind="mergesort")
+
+    temporal_file = "%s.%d.tmp.npz" % (index_file[:-len(".npz")], os.getpid())
+    np.savez(temporal_file, sequence=np.frombuffer(sequence, dtype=np.uint8), codes=codes[kmer_order],
+             positions=positions[kmer_order], kmer_size=np.array(kmer_size))
+    os.rename(temporal_file, index_file)
+
+    return index_file
+
+
+#Exact index of the last reference loaded by this process. The pairs of a reference come one after
+#another, so each process loads it once for all of them, and keeps only one index in memory
+LOADED_EXACT_INDEX = {}
+
+
+def load_exact_index(exact_index_file):
+    """
+    Load the index of make_exact_index, keeping it for the next pairs of the same reference.
+    Returns the sequence of the reference, the sorted k-mers, their positions and the k-mer size
+    """
+    import numpy as np
+
+    if exact_index_file not in LOADED_EXACT_INDEX:
+        LOADED_EXACT_INDEX.clear()
+        exact_index = np.load(exact_index_file)
+        LOADED_EXACT_INDEX[exact_index_file] = (exact_index["sequence"].tobytes(), exact_index["codes"],
+                                                exact_index["positions"], int(exact_index["kmer_size"]))
+
+    return LOADED_EXACT_INDEX[exact_index_file]
+
+
+def find_exact_fragments(exact_index_file, fragment_sequences, max_candidates=16):
+    """
+    Find the fragments that are in the reference exactly, on either strand. The first k-mer of
+    each fragment is looked up in the index of make_exact_index, and the fragment is compared
+    byte by byte with the reference at each position of that k-mer (up to max_candidates of
+    them): forward at the position, or reverse complemented ending at the end of the k-mer.
+    Fragments shorter than the k-mer, or with other bases than A, C, G or T in their first
+    k-mer, are left to blast.
+    Returns a boolean array, True for the fragments found exactly
+    """
+    import numpy as np
+
+    sequence, codes, positions, kmer_size = load_exact_index(exact_index_file)
+
+    exact = np.zeros(len(fragment_sequences), dtype=bool)
+    if not len(codes):
+        return exact
+
+    #First k-mer of every fragment, coded in one pass with an N between them. Shorter fragments
+    #are padded with Ns, so their k-mer is left out
+    first_kmers, kmer_positions = kmer_codes(b"N".join(fragment[:kmer_size].ljust(kmer_size, b"N")
+                                                       for fragment in fragment_sequences),
+                                             kmer_size, return_positions=True)
+    first_kmer_fragments = kmer_positions // (kmer_size + 1)
+    valid_kmers = (kmer_positions % (kmer_size + 1) == 0)
+    first_kmers = first_kmers[valid_kmers]
+    first_kmer_fragments = first_kmer_fragments[valid_kmers]
+
+    candidates_start = np.searchsorted(codes, first_kmers, side="left")
+    candidates_end = np.searchsorted(codes, first_kmers, side="right")
+
+    try:
+        complement = bytes.maketrans(b"ACGT", b"TGCA")
+    except AttributeError:  # Python 2
+        import string
+        complement = string.maketrans("ACGT", "TGCA")
+
+    for fragment_number, start, end in zip(first_kmer_fragments.tolist(), candidates_start.tolist(),
+                                           candidates_end.tolist()):
+        fragment = bytes(fragment_sequences[fragment_number])
+        fragment_length = len(fragment)
+        for position in positions[start:min(end, start + max_candidates)].tolist():
+            if sequence[position:position + fragment_length] == fragment:
+                exact[fragment_number] = True
+                break
+            reverse_start = position + kmer_size - fragment_length
+            if reverse_start >= 0 and \
+                    sequence[reverse_start:position + kmer_size].translate(complement)[::-1] == fragment:
+                exact[fragment_number] = True
+                break
+
+    return exact
+
+
+def read_fragment_sequences(fragments_file, number_fragments):
+    """
+    Returns the sequences of the fragments in a fragments file of write_query_fragments, in order
+    """
+    with open(fragments_file, 'rb') as fragments_input:
+        return fragments_input.read().split(b"\n")[1::2][:number_fragments]
+
+
+def write_remaining_fragments(fragments_file, fragment_sequences, exact):
+    """
+    Write the fragments that were not found exactly, with their original names, so the
+    blast results still refer to the fragment numbers of the genome
+    """
+    with open(fragments_file, 'wb') as fragments_output:
+        for fragment_number, fragment in enumerate(fragment_sequences):
+            if not exact[fragment_number]:
+                fragments_output.write(b">Fragment" + str(fragment_number + 1).encode("ascii") + b"\n")
+                fragments_output.write(fragment)
+                fragments_output.write(b"\n")
+
+
+def run_genome_pair(pair_task):
+    """
+    Blast the fragments of the query genome against the reference genome, inside a work
+    folder that is used only by this pair, so several pairs can run at the same time.
+    The task is a single tuple so the function can be used with a process pool.
+    Returns the pair, the values of calculate_ani and the StageTimer record of the pair
+    """
+    import os
+    import sys
+    import shutil
+
+    reference, query, reference_database, query_fragments, work_folder, num_threads, stream_blast, vectorized, \
+        exact_index = pair_task
+
+    if not os.path.exists(work_folder):
+        os.makedirs(work_folder)
+
+    #Load the query fragments, made once for each genome
+    fragment_query_file, fragment_lengths = load_query_fragments(query_fragments)
+
+    #Print information to screen
+    sys.stderr.write("Running blast of %s versus %s \n" % (reference, query))
+    sys.stderr.flush()
+
+    stage_timer = StageTimer(task="pair", reference=reference, query=query)
+
+    #Find the fragments that are in the reference exactly, and blast only the others
+    exact = None
+    if exact_index is not None:
+        with stage_timer.stage("exact matching"):
+            fragment_sequences = read_fragment_sequences(fragment_query_file, len(fragment_lengths))
+            exact = find_exact_fragments(exact_index, fragment_sequences)
+            fragment_query_file = work_folder + "/remaining_fragments.fna"
+            write_remaining_fragments(fragment_query_file, fragment_sequences, exact)
+
+        stage_timer.record["exact_fragments"] = int(exact.sum())
+
+    #Run blast, from a pipe or to the blast file. When the results are read from a pipe,
+    #blastn runs at the same time as the parsing, and both are measured as one stage
+    if exact is not None and exact.all():
+        blast_lines = []
+        parsing_stage = "top hit parsing"
+    elif stream_blast:
+        blast_lines = stream_blastn(reference_database, fragment_query_file, num_threads)
+        parsing_stage = "blastn and top hit parsing"
+    else:
+        with stage_timer.stage("blastn"):
+            blast_file = run_blastn(work_folder, reference_database, fragment_query_file, ("reference", "query"),
+                                    num_threads)
+        blast_lines = open(blast_file)
+        parsing_stage = "top hit parsing"
+
+    #Parse the blast result and calculate the ANI
+    if vectorized:
+        import numpy as np
+
+        with stage_timer.stage(parsing_stage):
+            identity, query_start, query_end, has_hit = read_blast_top_hit_arrays(blast_lines, len(fragment_lengths))
+        with stage_timer.stage("ANI calculation"):
+            if exact is not None:
+                identity[exact] = 100
+                query_start[exact] = 1
+                query_end[exact] = np.asarray(fragment_lengths)[exact]
+                has_hit |= exact
+            ani_values = calculate_ani_arrays(identity, query_start, query_end, has_hit, fragment_lengths)[:5]
+    else:
+        fragment_length_dict = {"Fragment" + str(fragment_number): fragment_length
+                                for fragment_number, fragment_length in enumerate(fragment_lengths, 1)}
+        exact_fragments = ()
+        if exact is not None:
+            exact_fragments = ["Fragment%d" % (fragment_number + 1) for fragment_number in exact.nonzero()[0]]
+        with stage_timer.stage(parsing_stage):
+            blast_top_hit = reduce_blast_top_hits(blast_lines)
+        with stage_timer.stage("ANI calculation"):
+            ani_values = calculate_ani(blast_top_hit, fragment_length_dict, exact_fragments)
+
+    if hasattr(blast_lines, "close") and not stream_blast:
+        blast_lines.close()
+
+    #The work folder of the pair is not needed anymore
+    shutil.rmtree(work_folder)
+
+    return (reference, query), ani_values, stage_timer.record
+
+
+def combined_genome_hash(genome_hashes):
+    """
+    Returns a hash for a list of genomes, from the hashes of their fasta files, in order
+    """
+    import hashlib
+
+    return hashlib.sha1("\t".join(genome_hashes).encode("ascii")).hexdigest()
+
+
+def make_combined_database(genome_files, cache_folder, combined_hash, temp_folder):
+    """
+    Build a single blast database with the contigs of all the genomes, where each contig
+    is renamed as g<index of the genome in genome_files>_<number of the contig>, so the
+    genome of every hit is known from the subject ID. The names are parsed as local IDs, so
+    blast reports them instead of its own ordinal IDs. The database is kept in the cache
+    folder like the databases of make_blast_database.
+    Returns the path of the database
+    """
+    import os
+    from Bio import SeqIO
+
+    if os.path.isdir(cache_folder + "/" + combined_hash):
+        return cache_folder + "/" + combined_hash + "/reference"
+
+    combined_file = temp_folder + "/combined_genomes.fna"
+    combined_output = open(combined_file, 'w')
+
+    for genome_index, genome_file in enumerate(genome_files):
+        for contig_number, seq_record in enumerate(SeqIO.parse(genome_file, "fasta"), 1):
+            combined_output.write(">g%d_%d\n%s\n" % (genome_index, contig_number, str(seq_record.seq)))
+
+    combined_output.close()
+
+    combined_database = make_blast_database(combined_file, cache_folder, combined_hash, ["-parse_seqids"])
+    os.remove(combined_file)
+
+    return combined_database
+
+
+def reduce_blast_top_hits_by_genome(blast_lines):
+    """
+    Select the top hit of each query against each genome of a combined database made by
+    make_combined_database, as the lines are read.
+    Returns a dictionary with the index of each subject genome and its top hits, in the
+    same format as reduce_blast_top_hits
+    """
+    genome_top_hits = {}
+
+    for blast_line in blast_lines:
+        blast_fields = blast_line.rstrip("\n").split("\t")
+        queryId = blast_fields[0]
+
+        #Remove the local ID prefix that some blast versions add
+        subjectId = blast_fields[1].split("|")[-1]
+        genome_index = int(subjectId[1:subjectId.index("_")])
+
+        if genome_index not in genome_top_hits:
+            genome_top_hits[genome_index] = {}
+        blast_top_hit = genome_top_hits[genome_index]
+
+        #get the top hit
+        if queryId in blast_top_hit and float(blast_fields[11]) < blast_top_hit[queryId][11]:
+            continue
+
+        blast_top_hit[queryId] = typed_blast_hit(blast_fields)
+
+    return genome_top_hits
+
+
+def run_all_vs_all_query(query_task):
+    """
+    Blast the fragments of the query genome once against the combined database of all the
+    genomes, and calculate the ANI against every other genome from the top hits of each one.
+    The task is a single tuple so the function can be used with a process pool.
+    Returns a list with each pair (reference, query) and the values of calculate_ani, and the
+    StageTimer record of the query
+    """
+    import os
+    import sys
+    import shutil
+
+    (query, genome_names, combined_database, max_target_seqs, query_fragments, work_folder, num_threads,
+     stream_blast) = query_task
+
+    if not os.path.exists(work_folder):
+        os.makedirs(work_folder)
+
+    fragment_query_file, fragment_lengths = load_query_fragments(query_fragments)
+    fragment_length_dict = {"Fragment" + str(fragment_number): fragment_length
+                            for fragment_number, fragment_length in enumerate(fragment_lengths, 1)}
+
+    sys.stderr.write("Running blast of all the genomes versus %s \n" % query)
+    sys.stderr.flush()
+
+    stage_timer = StageTimer(task="all_vs_all", query=query)
+
+    #Every genome of the database can be a top hit, so all the contigs can be reported
+    blast_parameters = ["-max_target_seqs", str(max_target_seqs)]
+
+    if stream_blast:
+        blast_lines = stream_blastn(combined_database, fragment_query_file, num_threads, blast_parameters)
+        parsing_stage = "blastn and top hit parsing"
+    else:
+        with stage_timer.stage("blastn"):
+            blast_file = run_blastn(work_folder, combined_database, fragment_query_file, ("all", "query"),
+                                    num_threads, blast_parameters)
+        blast_lines = open(blast_file)
+        parsing_stage = "top hit parsing"
+
+    with stage_timer.stage(parsing_stage):
+        genome_top_hits = reduce_blast_top_hits_by_genome(blast_lines)
+
+    if not stream_blast:
+        blast_lines.close()
+
+    shutil.rmtree(work_folder)
+
+    with stage_timer.stage("ANI calculation"):
+        query_results = [((reference, query), calculate_ani(genome_top_hits.get(genome_index, {}),
+                                                            fragment_length_dict))
+                         for genome_index, reference in enumerate(genome_names) if reference != query]
+
+    return query_results, stage_timer.record
+
+
+def flatten_query_results(query_results, missing_pairs):
+    """
+    Yields the missing pairs of the results of run_all_vs_all_query one at a time, like the
+    results of run_genome_pair. The other pairs of each query are dropped, and the StageTimer
+    record of each query goes with its first missing pair
+    """
+    for query_pair_results, timing_record in query_results:
+        for genome_pair, ani_values in query_pair_results:
+            if genome_pair not in missing_pairs:
+                continue
+            yield genome_pair, ani_values, timing_record
+            timing_record = None
+
+
+def format_pair_results(genome_pair, reference_stats, query_stats, ani_values):
+    """
+    Takes the values of calculate_ani for a pair and the GenomeStats of both genomes.
+    Returns the log text for the query, the row of the mapping summary and the ANI
+    """
+    reference, query = genome_pair
+    sum_identity, number_hits, total_aligned_bases, total_unaligned_fragments, total_unaligned_bases = ani_values
+
+    #Print total number of fragments
+    log_text = "For the query genome: %s \n" % query
+    log_text += "Genome size: %d \n" % query_stats.genome_size
+    log_text += "Genome size, with no Ns: %d\n" % query_stats.trimmed_genome_size
+    log_text += "Number of fragments: %d \n" % query_stats.fragments
+
+    try:
+        reference_query_ani = sum_identity / number_hits
+    except ZeroDivisionError:  # Cases were there are no hits
+        reference_query_ani = 0
+
+    results = [reference, str(reference_stats.genome_size), query, str(query_stats.trimmed_genome_size),
+               str(query_stats.fragments), str(number_hits), str(reference_query_ani),
+               str(total_aligned_bases), str(total_unaligned_fragments), str(total_unaligned_bases)]
+
+    return log_text, results, reference_query_ani
+
+
+def open_results_store(store_file):
+    """
+    Open the SQLite file that keeps the values of calculate_ani of every pair computed
+    by previous runs, one row per direction of the pair, keyed by the hashes of the
+    reference and query genomes and by the parameters of the analysis
+    """
+    import sqlite3
+
+    results_store = sqlite3.connect(store_file)
+    results_store.execute("CREATE TABLE IF NOT EXISTS pair_results ("
+                          "reference_hash TEXT, query_hash TEXT, parameters TEXT, "
+                          "sum_identity REAL, number_hits INTEGER, total_aligned_bases INTEGER, "
+                          "total_unaligned_fragments INTEGER, total_unaligned_bases INTEGER, "
+                          "PRIMARY KEY (reference_hash, query_hash, parameters))")
+    results_store.commit()
+
+    return results_store
+
+
+def load_pair_result(results_store, reference_hash, query_hash, parameters):
+    """
+    Returns the stored values of calculate_ani for the pair, or None if it was not computed
+    """
+    return results_store.execute("SELECT sum_identity, number_hits, total_aligned_bases, "
+                                 "total_unaligned_fragments, total_unaligned_bases FROM pair_results "
+                                 "WHERE reference_hash = ? AND query_hash = ? AND parameters = ?",
+                                 (reference_hash, query_hash, parameters)).fetchone()
+
+
+def save_pair_result(results_store, reference_hash, query_hash, parameters, ani_values):
+    """
+    Store the values of calculate_ani for the pair, replacing any previous result
+    """
+    results_store.execute("INSERT OR REPLACE INTO pair_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (reference_hash, query_hash, parameters) + tuple(ani_values))
+    results_store.commit()
+
+
+def iter_checkpoint(checkpoint_file, parameters):
+    """
+    Read the pairs completed by an interrupted run from its checkpoint file, one line at a
+    time. The first line has the parameters of the run, and each following line a pair with
+    the hashes of both genomes and the values of calculate_ani. A last line cut by the
+    interruption is ignored. Yields each pair, the hashes of its genomes and its values
+    """
+    with open(checkpoint_file) as checkpoint:
+        if checkpoint.readline().rstrip("\n") != "#" + parameters:
+            raise ValueError("The checkpoint %s was made with other parameters" % checkpoint_file)
+
+        for checkpoint_line in checkpoint:
+            if not checkpoint_line.endswith("\n"):
+                break
+
+            checkpoint_fields = checkpoint_line.rstrip("\n").split("\t")
+            reference, query, reference_hash, query_hash = checkpoint_fields[:4]
+            ani_values = (float(checkpoint_fields[4]),) + tuple(int(value) for value in checkpoint_fields[5:])
+            yield (reference, query), (reference_hash, query_hash), ani_values
+
+
+#Option or setting behind each parameter of the checkpoint, to name the one that changed
+CHECKPOINT_OPTIONS = {"fragment_size": "fragment size", "kmer_backend": "--fragment_kmer_size",
+                      "blastn_below": "ANI below which the kmer backend uses blastn", "blastn": "blastn parameters",
+                      "all_vs_all": "--all_vs_all"}
+
+
+def checkpoint_changed_option(checkpoint_file, parameters):
+    """
+    Compare the parameters in the first line of the checkpoint file with the parameters of
+    the run. Returns the option that changed, or None if they are the same
+    """
+    with open(checkpoint_file) as checkpoint:
+        checkpoint_parameters = checkpoint.readline().rstrip("\n")[1:]
+
+    if checkpoint_parameters == parameters:
+        return None
+
+    checkpoint_values = dict(parameter.partition("=")[::2] for parameter in checkpoint_parameters.split(";"))
+    run_values = dict(parameter.partition("=")[::2] for parameter in parameters.split(";"))
+
+    if ("kmer_backend" in checkpoint_values) != ("kmer_backend" in run_values):
+        return "--backend"
+    for parameter in sorted(set(checkpoint_values) | set(run_values)):
+        if checkpoint_values.get(parameter) != run_values.get(parameter):
+            return CHECKPOINT_OPTIONS.get(parameter, parameter)
+
+    return "parameters"
+
+
+def index_checkpoint(checkpoint_file, parameters, index_file):
+    """
+    Copy the pairs of the checkpoint file to a SQLite file indexed by the pair, to look them
+    up one at a time without keeping all of them in memory. Returns the connection
+    """
+    import os
+    import sqlite3
+
+    #The index of a previous resume survives in the temp folder if that run was interrupted too
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+
+    checkpoint_index = sqlite3.connect(index_file)
+    checkpoint_index.execute("DROP TABLE IF EXISTS checkpoint_pairs")
+    checkpoint_index.execute("CREATE TABLE checkpoint_pairs (reference TEXT, query TEXT, reference_hash TEXT, "
+                             "query_hash TEXT, sum_identity REAL, number_hits INTEGER, "
+                             "total_aligned_bases INTEGER, total_unaligned_fragments INTEGER, "
+                             "total_unaligned_bases INTEGER, PRIMARY KEY (reference, query))")
+    checkpoint_index.executemany("INSERT OR REPLACE INTO checkpoint_pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (genome_pair + genome_hashes + ani_values for genome_pair, genome_hashes, ani_values
+                                  in iter_checkpoint(checkpoint_file, parameters)))
+    checkpoint_index.commit()
+
+    return checkpoint_index
+
+
+def load_checkpoint_pair(checkpoint_index, genome_pair, genome_hashes):
+    """
+    Returns the values of the pair in the checkpoint index, or None if it is not there or
+    any of its genomes changed
+    """
+    checkpoint_row = checkpoint_index.execute("SELECT reference_hash, query_hash, sum_identity, number_hits, "
+                                              "total_aligned_bases, total_unaligned_fragments, "
+                                              "total_unaligned_bases FROM checkpoint_pairs "
+                                              "WHERE reference = ? AND query = ?", genome_pair).fetchone()
+    if checkpoint_row is None or tuple(checkpoint_row[:2]) != tuple(genome_hashes):
+        return None
+
+    return checkpoint_row[2:]
+
+
+def open_checkpoint(checkpoint_file, parameters, resume):
+    """
+    Open the checkpoint file to append the completed pairs. A new checkpoint is started
+    unless the run is resumed, in which case a last line cut by the interruption is removed
+    """
+    import os
+
+    if not resume or not os.path.isfile(checkpoint_file):
+        checkpoint = open(checkpoint_file, 'w')
+        checkpoint.write("#" + parameters + "\n")
+        return checkpoint
+
+    #Find the end of the last complete line, reading back from the end of the file
+    with open(checkpoint_file, 'rb+') as checkpoint:
+        checkpoint.seek(0, os.SEEK_END)
+        position = checkpoint.tell()
+        while position > 0:
+            block_size = min(1 << 16, position)
+            position -= block_size
+            checkpoint.seek(position)
+            last_newline = checkpoint.read(block_size).rfind(b"\n")
+            if last_newline >= 0:
+                position += last_newline + 1
+                break
+        checkpoint.truncate(position)
+
+    return open(checkpoint_file, 'a')
+
+
+def write_checkpoint(checkpoint, genome_pair, genome_hashes, ani_values):
+    """
+    Append a completed pair to the checkpoint, and force it to the disk so it is kept
+    even if the run is interrupted right after
+    """
+    import os
+
+    sum_identity = ani_values[0]
+    checkpoint.write("\t".join(list(genome_pair) + list(genome_hashes) + [repr(float(sum_identity))] +
+                                [str(value) for value in ani_values[1:]]) + "\n")
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+
+def run_planned_pairs(planned_pairs, pair_function, pool, max_pending=1000):
+    """
+    Run the tasks of the planned pairs, taking the plan lazily and keeping at most max_pending
+    pairs ahead of the output. Each planned pair is (genome pair, status, value), where the value
+    is the task of pair_function for the "missing" pairs, and the known result for the others.
+    Yields the pairs in the order of the plan as (genome pair, status, value, StageTimer record),
+    with the values of calculate_ani of the computed pairs
+    """
+    from collections import deque
+
+    pending_pairs = deque()
+    for genome_pair, status, value in planned_pairs:
+        if status == "missing":
+            value = pool.apply_async(pair_function, (value,)) if pool is not None else pair_function(value)
+        pending_pairs.append((genome_pair, status, value))
+
+        #Without a pool, each pair was computed right away
+        while pending_pairs and (pool is None or len(pending_pairs) > max_pending):
+            yield finish_planned_pair(pool, *pending_pairs.popleft())
+
+    while pending_pairs:
+        yield finish_planned_pair(pool, *pending_pairs.popleft())
+
+
+def finish_planned_pair(pool, genome_pair, status, value):
+    """
+    Waits for the result of a pair of run_planned_pairs, if it was computed
+    """
+    if status != "missing":
+        return genome_pair, status, value, None
+
+    computed_pair, ani_values, timing_record = value.get() if pool is not None else value
+    return genome_pair, status, ani_values, timing_record
+
+
+def collect_planned_pairs(planned_pairs, pair_results):
+    """
+    Match the results of the missing pairs of the plan, computed outside run_planned_pairs and
+    received in any order as (pair, values of calculate_ani, StageTimer record), to the plan.
+    Yields the pairs in the order of the plan, like run_planned_pairs. Results received before
+    their turn are kept until then
+    """
+    computed_results = {}
+
+    for genome_pair, status, value in planned_pairs:
+        if status != "missing":
+            yield genome_pair, status, value, None
+            continue
+
+        while genome_pair not in computed_results:
+            pair_result = next(pair_results, None)
+            if pair_result is None:
+                raise RuntimeError("No result was received for the pair %s versus %s" % genome_pair)
+            computed_pair, ani_values, timing_record = pair_result
+            computed_results[computed_pair] = (ani_values, timing_record)
+
+        ani_values, timing_record = computed_results.pop(genome_pair)
+        yield genome_pair, status, ani_values, timing_record
+
+
+def split_core_budget(total_cores, concurrent_pairs):
+    """
+    Split the number of cores between the pairs that run at the same time and the
+    threads used by each blastn. Returns the number of pairs and the blastn threads
+    """
+    concurrent_pairs = max(1, min(concurrent_pairs, total_cores))
+    blast_threads = max(1, total_cores // concurrent_pairs)
+
+    return concurrent_pairs, blast_threads
+
+#Folders of the shared work queue, a task moves from pending to claimed, and its result to done or failed
+QUEUE_FOLDERS = ("pending", "claimed", "done", "failed")
+
+
+def make_work_queue(queue_directory):
+    """
+    Create the folders of the work queue, shared by the coordinator and the workers
+    """
+    import os
+
+    for queue_folder in QUEUE_FOLDERS:
+        if not os.path.exists(queue_directory + "/" + queue_folder):
+            try:
+                os.makedirs(queue_directory + "/" + queue_folder)
+            except OSError:  # Created by another process at the same time
+                if not os.path.isdir(queue_directory + "/" + queue_folder):
+                    raise
+
+
+def pair_task_name(reference_hash, query_hash, parameters):
+    """
+    Returns the name of the task of a pair in the queue, from the hashes of both genomes and
+    the parameters, so a pair is queued only once and its result can be found by any run
+    """
+    import hashlib
+
+    return hashlib.sha1("\t".join([reference_hash, query_hash, parameters]).encode("ascii")).hexdigest()
+
+
+def write_queue_file(queue_file, queue_record):
+    """
+    Write a task or a result as JSON to a temporal file in the same folder, and rename it,
+    so the other nodes never read a partial file. Rename is atomic on NFS too
+    """
+    import os
+    import json
+    import socket
+
+    temporal_file = "%s/.%s.%s.%d.tmp" % (os.path.dirname(queue_file), os.path.basename(queue_file),
+                                          socket.gethostname(), os.getpid())
+    with open(temporal_file, 'w') as queue_output:
+        json.dump(queue_record, queue_output)
+    os.rename(temporal_file, queue_file)
+
+
+def enqueue_pair_tasks(queue_directory, pair_tasks):
+    """
+    Add the tasks, a list of task names and task records, to the pending folder. Tasks that
+    are already pending, claimed or done are not queued again, and failed tasks are retried
+    """
+    import os
+
+    queued_tasks = set(os.listdir(queue_directory + "/pending"))
+    queued_tasks.update(task_file.split(".")[0] for task_file in os.listdir(queue_directory + "/claimed"))
+    queued_tasks.update(os.listdir(queue_directory + "/done"))
+
+    for task_name, task_record in pair_tasks:
+        if os.path.isfile(queue_directory + "/failed/" + task_name):
+            os.remove(queue_directory + "/failed/" + task_name)
+        if task_name not in queued_tasks:
+            write_queue_file(queue_directory + "/pending/" + task_name, task_record)
+
+
+def queue_clock(queue_directory):
+    """
+    Returns the current time of the file server of the queue, from the modification time of
+    a file written to it, so the age of the claims does not depend on the clocks of the nodes
+    """
+    import os
+    import socket
+
+    clock_file = "%s/.clock.%s.%d" % (queue_directory, socket.gethostname(), os.getpid())
+    with open(clock_file, 'w') as clock_output:
+        clock_output.write("\n")
+    clock_time = os.stat(clock_file).st_mtime
+    os.remove(clock_file)
+
+    return clock_time
+
+
+def requeue_stale_claims(queue_directory, claim_timeout):
+    """
+    Move the claimed tasks that were not touched by their worker for claim_timeout seconds
+    back to the pending folder, so the tasks of a worker that died are run by another one
+    """
+    import os
+
+    clock_time = queue_clock(queue_directory)
+    for claim_file in os.listdir(queue_directory + "/claimed"):
+        claim_path = queue_directory + "/claimed/" + claim_file
+        try:
+            if clock_time - os.stat(claim_path).st_mtime > claim_timeout:
+                os.rename(claim_path, queue_directory + "/pending/" + claim_file.split(".")[0])
+        except OSError:  # Finished or requeued by another process
+            continue
+
+
+def claim_pair_task(queue_directory):
+    """
+    Claim a pending task by renaming it to the claimed folder, with the host and process in the
+    name. Only one worker can rename the file, the others get an error and try the next task.
+    Returns the claimed file and the task record, or None if no task is pending
+    """
+    import os
+    import json
+    import socket
+
+    for task_name in sorted(os.listdir(queue_directory + "/pending")):
+        if task_name.startswith("."):
+            continue
+
+        claim_file = "%s/claimed/%s.%s.%d" % (queue_directory, task_name, socket.gethostname(), os.getpid())
+        try:
+            os.rename(queue_directory + "/pending/" + task_name, claim_file)
+        except OSError:  # Claimed by another worker
+            continue
+
+        #Touch the claim, the time it was pending does not count for the timeout
+        os.utime(claim_file, None)
+        with open(claim_file) as task_input:
+            return claim_file, json.load(task_input)
+
+    return None
+
+
+def touch_claim(claim_file, stop_event, interval):
+    """
+    Update the modification time of a claim until stop_event is set, so the claim of a
+    task that runs longer than the timeout is not taken as stale
+    """
+    import os
+
+    while not stop_event.wait(interval):
+        try:
+            os.utime(claim_file, None)
+        except OSError:  # Requeued by another process
+            return
+
+
+def run_queue_worker(queue_directory, num_threads, claim_timeout, poll_interval):
+    """
+    Run the pending tasks of the queue one at a time, writing the result of each pair to the
+    done folder, or the error to the failed folder. Stale claims are requeued while waiting.
+    Returns the number of tasks run, when no task is pending or claimed
+    """
+    import os
+    import time
+    import shutil
+    import socket
+    import tempfile
+    import threading
+    import traceback
+
+    make_work_queue(queue_directory)
+    tasks_run = 0
+
+    while True:
+        claimed_task = claim_pair_task(queue_directory)
+        if claimed_task is None:
+            if not os.listdir(queue_directory + "/claimed"):
+                return tasks_run
+            #Other workers are still running, wait in case one of them dies
+            time.sleep(poll_interval)
+            requeue_stale_claims(queue_directory, claim_timeout)
+            continue
+
+        claim_file, task_record = claimed_task
+        task_name = os.path.basename(claim_file).split(".")[0]
+
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=touch_claim, args=(claim_file, stop_event, claim_timeout / 4.0))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        #The blast file is written to a local folder of the node
+        work_folder = tempfile.mkdtemp(prefix="ANI_pair_")
+        pair_task = (task_record["reference"], task_record["query"], task_record["reference_database"],
+                     task_record["query_fragments"], work_folder, num_threads, task_record["stream_blast"],
+                     task_record["vectorized"], task_record.get("exact_index"))
+        try:
+            genome_pair, ani_values, timing_record = run_genome_pair(pair_task)
+        except Exception:
+            shutil.rmtree(work_folder, ignore_errors=True)
+            with open(queue_directory + "/failed/" + task_name, 'w') as failed_output:
+                failed_output.write("%s, %s: %s" % (socket.gethostname(), " versus ".join(pair_task[:2]),
+                                                    traceback.format_exc()))
+        else:
+            timing_record["host"] = socket.gethostname()
+            write_queue_file(queue_directory + "/done/" + task_name,
+                             dict(task_record, ani_values=list(ani_values), timing_record=timing_record))
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+        try:
+            os.remove(claim_file)
+        except OSError:  # Requeued while it was running, the result is the same
+            pass
+
+        tasks_run += 1
+
+
+def collect_queue_results(queue_directory, task_names, claim_timeout, poll_interval):
+    """
+    Wait for the results of the tasks in the done folder, and yields the task name, the values
+    of calculate_ani and the StageTimer record of each one, in the order they are finished.
+    The result files are removed once they are read.
+    Stale claims are requeued while waiting, and a failed task raises a RuntimeError
+    """
+    import os
+    import json
+    import time
+
+    remaining_tasks = set(task_names)
+
+    while remaining_tasks:
+        failed_tasks = remaining_tasks.intersection(os.listdir(queue_directory + "/failed"))
+        if failed_tasks:
+            with open(queue_directory + "/failed/" + sorted(failed_tasks)[0]) as failed_input:
+                raise RuntimeError("A task of the queue failed in %s" % failed_input.read())
+
+        finished_tasks = remaining_tasks.intersection(os.listdir(queue_directory + "/done"))
+        for task_name in sorted(finished_tasks):
+            with open(queue_directory + "/done/" + task_name) as result_input:
+                task_result = json.load(result_input)
+            remaining_tasks.remove(task_name)
+            os.remove(queue_directory + "/done/" + task_name)
+
+            yield task_name, tuple(task_result["ani_values"]), task_result["timing_record"]
+
+        if remaining_tasks and not finished_tasks:
+            time.sleep(poll_interval)
+            requeue_stale_claims(queue_directory, claim_timeout)
+
+
+def fan_out_queue_results(queue_results, task_pairs):
+    """
+    Yields the result of each task of collect_queue_results for every pair of the run that
+    maps to the task, like the results of run_genome_pair. The pairs come from task_pairs,
+    with the genome names of this run, as genomes with the same content share their tasks.
+    The StageTimer record of each task goes with its first pair
+    """
+    for task_name, ani_values, timing_record in queue_results:
+        for genome_pair in task_pairs[task_name]:
+            yield genome_pair, ani_values, timing_record
+            timing_record = None
+
+
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import argparse
+    import os
+    import itertools
+    import multiprocessing
+    from functools import partial
+    import numpy as np
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import scipy.cluster.hierarchy as sch
+    import scipy.spatial.distance
+
+    program_description = "Script that takes a list of genomes, containing the location of the fasta files," \
+                          "and generates a matrix with the ANI values for all the combinations"
+
+    parser = argparse.ArgumentParser(description=program_description)
+
+    parser.add_argument("-i", "--genome_input_list", type=str,
+                        help="List with the genome names and files (required, except for the workers)")
+
+    parser.add_argument("-o", "--output_directory", type=str,
+                        help="Output directory (required, except for the workers)")
+
+    parser.add_argument("-t", "--threads", type=int, default=4,
+                        help="Total number of cores to use, split between the pairs that run at the same "
+                             "time and the blastn threads of each pair (default: 4)")
+
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="Number of genome pairs to run at the same time (default: 1)")
+
+    parser.add_argument("-c", "--cache_directory", type=str,
+                        help="Folder to keep the files built for each genome, the blast databases and the "
+                             "query fragments, so they are reused by later runs "
+                             "(default: output_directory/cache)")
+
+    parser.add_argument("--stream_blast", action="store_true",
+                        help="Read the blastn results from a pipe and keep only the top hit of each fragment, "
+                             "instead of writing the blast file of each pair")
+
+    parser.add_argument("--vectorized", action="store_true",
+                        help="Keep the top hits as numpy arrays, read in batches, and calculate the ANI of "
+                             "each pair in a single vectorized pass. Not available with --all_vs_all")
+
+    parser.add_argument("--results_store", type=str,
+                        help="SQLite file with the results of the pairs computed by previous runs, only the "
+                             "missing pairs are computed (default: cache_directory/ani_results.sqlite)")
+
+    parser.add_argument("--recompute", action="store_true",
+                        help="Compute all the pairs again, replacing the results in the results store")
+
+    parser.add_argument("--prescreen_ani", type=float,
+                        help="Estimate the ANI of every pair from MinHash sketches first, and skip blast for "
+                             "the pairs with an estimated ANI below this value. The matrix uses the "
+                             "estimated ANI for the skipped pairs, capped at the detection limit of the "
+                             "sketches, and matrix_estimated.txt marks them with 1. The value must be above "
+                             "the detection limit of the sketches, the ANI of a single shared hash: about 62.7 "
+                             "with the default sizes, 70.4 with 1000 hashes (default: no prescreen)")
+
+    parser.add_argument("--kmer_size", type=int, default=21, help="K-mer size for the sketches (default: 21)")
+
+    parser.add_argument("--sketch_size", type=int, default=5000,
+                        help="Number of hashes in the sketch of each genome, larger sketches detect more "
+                             "distant pairs (default: 5000)")
+
+    parser.add_argument("--all_vs_all", action="store_true",
+                        help="Build a single blast database with all the genomes and blast the fragments of each "
+                             "genome once against it, splitting the top hits by genome. The e-values depend on "
+                             "the size of the database, so weak hits can differ from the pairwise runs")
+
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run in the same output directory, skipping the pairs "
+                             "in its checkpoint and writing the results of all the pairs again")
+
+    parser.add_argument("--one_direction", action="store_true",
+                        help="Compute each pair of genomes in a single direction, with the smaller genome as the "
+                             "query, instead of averaging both directions. Halves the blast time, the values "
+                             "are marked as one-directional in the log and the matrix")
+
+    parser.add_argument("--matrix_memmap", action="store_true",
+                        help="Fill the matrix as a memory map of matrix_file.npy instead of an array in memory, "
+                             "for runs with many genomes. The matrix is filled as the pairs arrive, so the run "
+                             "keeps no other copy of the results of every pair")
+
+    parser.add_argument("--no_dendrogram", action="store_true",
+                        help="Do not make the dendrogram of the matrix, ANI_hier_plot.pdf, which is slow and "
+                             "unreadable for runs with many genomes")
+
+    parser.add_argument("--exact_matches", action="store_true",
+                        help="Look for each fragment in the reference first, and blast only the fragments that "
+                             "are not found exactly. The exact fragments count as hits with 100%% identity over "
+                             "their full length. Saves most of the blast time for near-clonal genomes")
+
+    parser.add_argument("--backend", choices=("blastn", "kmer"), default="blastn",
+                        help="How the fragments are mapped to the reference. kmer estimates the identity of each "
+                             "fragment from the fraction of its k-mers found in the reference, with no blast. "
+                             "With 16-mers it is within 0.5 points of the true ANI from 99%%%% to 85%%%% ANI, and "
+                             "up to 1.5 points high from 85%%%% to 80%%%%. Below that too few k-mers are found to "
+                             "estimate it, so the pairs estimated below %d%%%% or with no mapped fragment are "
+                             "computed with blastn (default: blastn)" % KMER_BACKEND_MIN_ANI)
+
+    parser.add_argument("--fragment_kmer_size", type=int, default=16,
+                        help="K-mer size of the kmer backend, up to 32 (default: 16)")
+
+    parser.add_argument("--cluster_ani", type=float,
+                        help="Single linkage clusters of the genomes with an ANI of at least this value, like 95 "
+                             "for species, built as the pairs are computed and written to clusters.txt "
+                             "(default: no clusters)")
+
+    parser.add_argument("--no_matrix", action="store_true",
+                        help="Do not keep the ANI of the pairs for the matrix, and skip the matrix and the "
+                             "dendrogram, for runs with many genomes that only need the clusters. The pairs "
+                             "are planned one at a time, except with --all_vs_all and --queue_directory")
+
+    parser.add_argument("--queue_directory", type=str,
+                        help="Shared folder, on NFS or any file system seen by all the nodes, with a queue of the "
+                             "pairs to compute. The run builds the databases and fragments, queues the missing "
+                             "pairs, waits for their results and writes the matrix. The cache directory has to "
+                             "be shared too. Not used with --all_vs_all")
+
+    parser.add_argument("--worker", action="store_true",
+                        help="Run the pairs of --queue_directory with -t threads, one at a time, and exit when no "
+                             "pair is pending or running. Start any number of workers on any node, once the "
+                             "pairs are queued")
+
+    parser.add_argument("--claim_timeout", type=float, default=3600,
+                        help="Seconds without news from the worker of a pair before the pair is queued again. "
+                             "Running workers touch their claims every quarter of this time (default: 3600)")
+
+    parser.add_argument("--poll_interval", type=float, default=10,
+                        help="Seconds between the checks of the queue while waiting (default: 10)")
+
+    args = parser.parse_args()
+
+    #Workers only need the queue, everything else is in the tasks
+    if args.worker:
+        if args.queue_directory is None:
+            parser.error("--worker needs --queue_directory")
+        tasks_run = run_queue_worker(args.queue_directory, args.threads, args.claim_timeout, args.poll_interval)
+        sys.stderr.write("%d pairs computed by this worker\n" % tasks_run)
+        sys.exit(0)
+
+    if args.genome_input_list is None or args.output_directory is None:
+        parser.error("-i/--genome_input_list and -o/--output_directory are required")
+    if args.queue_directory is not None and args.all_vs_all:
+        parser.error("--queue_directory can not be used with --all_vs_all")
+    if args.backend == "kmer" and (args.all_vs_all or args.queue_directory is not None):
+        parser.error("--backend kmer can not be used with --all_vs_all or --queue_directory")
+    if args.exact_matches and (args.all_vs_all or args.backend == "kmer"):
+        parser.error("--exact_matches can not be used with --all_vs_all or --backend kmer")
+    if args.vectorized and args.all_vs_all:
+        parser.error("--vectorized can not be used with --all_vs_all")
+    #Every pair that the sketches detect is estimated at or above the limit, so a prescreen at or below it
+    #would not skip any pair
+    if args.prescreen_ani is not None and \
+            args.prescreen_ani <= sketch_detection_limit(args.kmer_size, args.sketch_size):
+        parser.error("--prescreen_ani must be above %.1f, the detection limit of sketches of %d hashes with "
+                     "k=%d. Use a larger --sketch_size or a smaller --kmer_size" %
+                     (sketch_detection_limit(args.kmer_size, args.sketch_size), args.sketch_size, args.kmer_size))
+
+    #Parameters for blast and fragments, stored with the results of each pair
+    fragment_size = 500
+    if args.backend == "kmer":
+        pair_parameters = "fragment_size=%d;kmer_backend=%d;blastn_below=%d" % (fragment_size, args.fragment_kmer_size,
+                                                                                 KMER_BACKEND_MIN_ANI)
+    else:
+        pair_parameters = "fragment_size=%d;blastn=%s" % (fragment_size, " ".join(BLASTN_PARAMETERS))
+    if args.all_vs_all:
+        pair_parameters += ";all_vs_all"
+
+    #A resumed run must use the parameters of its checkpoint
+    checkpoint_file = args.output_directory + "/checkpoint.txt"
+    if args.resume and os.path.isfile(checkpoint_file):
+        changed_option = checkpoint_changed_option(checkpoint_file, pair_parameters)
+        if changed_option is not None:
+            parser.error("--resume: the checkpoint in %s was made with other parameters: %s changed" %
+                         (args.output_directory, changed_option))
+
+    #Create output directory
+    if not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+
+    #Create temporal folder for the blast analysis
+    temp_folder = args.output_directory + "/temp"
+    if not os.path.exists(temp_folder):
+        os.makedirs(temp_folder)
+
+    #Create the cache folders, kept after the run
+    if args.cache_directory is None:
+        args.cache_directory = args.output_directory + "/cache"
+    if args.results_store is None:
+        args.results_store = args.cache_directory + "/ani_results.sqlite"
+    database_cache = args.cache_directory + "/blastdb"
+    fragments_cache = args.cache_directory + "/fragments"
+    sketches_cache = args.cache_directory + "/sketches"
+    kmer_index_cache = args.cache_directory + "/kmer_index"
+    exact_index_cache = args.cache_directory + "/exact_index"
+    for cache_folder in (database_cache, fragments_cache, sketches_cache, kmer_index_cache, exact_index_cache):
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+    #Read the genome list:
+    genome_info = {element[0]: element[1] for element in [line.split("\t") for line in [line.rstrip() for line in open(args.genome_input_list)] if line.strip()]}
+
+    #Check that the files exists
+    for genome in genome_info:
+        if not os.path.isfile(genome_info[genome]):
+            print("The fasta for %s was not found" % genome)
+            sys.exit("Check the path for the files")
+
+    #Create log file
+    log_output = open(args.output_directory + "/logfile.txt", 'w')
+    mapping_summary = open(args.output_directory + "/mapping_summary.txt", 'w')
+
+    mapping_summary.write("Reference\tReference Genome size\t"
+                          "Query\tQuery Genome Size\t"
+                          "Total number fragments\tMapped Fragments\tIdentity\t"
+                          "Mapped Bases\tUnmapped fragments\tUnmapped Bases\n")
+
+    #Timing of the stages of each genome and pair, and their summary
+    timing_output = open(args.output_directory + "/timing.jsonl", 'w')
+    timing_summary = {}
+
+    concurrent_pairs, blast_threads = split_core_budget(args.threads, args.processes)
+
+    #The pool is shared by the database builds and the genome pairs
+    pool = multiprocessing.Pool(concurrent_pairs) if concurrent_pairs > 1 else None
+    pool_map = pool.map if pool is not None else map
+
+    #Build the blast database and the query fragments of each genome only once, keyed by the content of the fasta
+    genome_hash = {genome: genome_file_hash(genome_info[genome]) for genome in genome_info}
+    genome_names = sorted(genome_info)
+    if args.backend == "kmer":
+        genome_kmer_index = {}
+        index_tasks = [(genome_info[genome], kmer_index_cache, genome_hash[genome], args.fragment_kmer_size)
+                       for genome in genome_names]
+        for genome, (kmer_index, timing_record) in zip(genome_names, pool_map(
+                partial(timed_genome_task, "k-mer indexing", make_kmer_index), index_tasks)):
+            genome_kmer_index[genome] = kmer_index
+            write_timing_record(timing_output, timing_summary, timing_record)
+
+    elif not args.all_vs_all:
+        genome_database = {}
+        database_tasks = [(genome_info[genome], database_cache, genome_hash[genome]) for genome in genome_names]
+        for genome, (database, timing_record) in zip(genome_names, pool_map(
+                partial(timed_genome_task, "makeblastdb", make_blast_database), database_tasks)):
+            genome_database[genome] = database
+            write_timing_record(timing_output, timing_summary, timing_record)
+
+    #Index for the exact match pre-pass, None for each genome when it is not used
+    genome_exact_index = dict.fromkeys(genome_names)
+    if args.exact_matches:
+        index_tasks = [(genome_info[genome], exact_index_cache, genome_hash[genome]) for genome in genome_names]
+        for genome, (exact_index, timing_record) in zip(genome_names, pool_map(
+                partial(timed_genome_task, "exact match indexing", make_exact_index), index_tasks)):
+            genome_exact_index[genome] = os.path.abspath(exact_index)
+            write_timing_record(timing_output, timing_summary, timing_record)
+
+    genome_fragments = {}
+    fragments_tasks = [(genome_info[genome], fragments_cache, genome_hash[genome], fragment_size)
+                       for genome in genome_names]
+    for genome, (fragments, timing_record) in zip(genome_names, pool_map(
+            partial(timed_genome_task, "fragmenting", make_query_fragments), fragments_tasks)):
+        genome_fragments[genome] = fragments
+        write_timing_record(timing_output, timing_summary, timing_record)
+
+    #Index of the genome statistics, collected when each genome was fragmented
+    genome_stats = {genome: load_genome_stats(genome_fragments[genome]) for genome in genome_names}
+
+    stats_output = open(args.output_directory + "/genome_stats.txt", 'w')
+    stats_output.write("Genome\tGenome size\tGenome size, with no Ns\tContigs\tFragments\n")
+    for genome in genome_names:
+        stats_output.write(genome + "\t" + "\t".join(str(value) for value in genome_stats[genome]) + "\n")
+    stats_output.close()
+
+    #Pairs already in the results store are not computed again
+    results_store = open_results_store(args.results_store)
+
+    if args.one_direction:
+        genome_combinations = one_directional_pairs(genome_names, genome_stats)
+        log_output.write("One-directional ANI: each pair is computed once, with the smaller genome as the query\n")
+    else:
+        genome_combinations = itertools.permutations(genome_info.keys(), 2)
+
+    #Skip the pairs that are too distant, from the ANI estimated with the sketches
+    if args.prescreen_ani is not None:
+        genome_sketches = {}
+        sketch_tasks = [(genome_info[genome], sketches_cache, genome_hash[genome], args.kmer_size, args.sketch_size)
+                        for genome in genome_names]
+        for genome, (sketch_file, timing_record) in zip(genome_names, pool_map(
+                partial(timed_genome_task, "sketching", make_genome_sketch), sketch_tasks)):
+            genome_sketches[genome] = np.load(sketch_file)
+            write_timing_record(timing_output, timing_summary, timing_record)
+
+        prescreen_summary = open(args.output_directory + "/prescreen_summary.txt", 'w')
+        prescreen_summary.write("Reference\tQuery\tMash distance\tEstimated ANI\tStatus\n")
+
+        #Pairs that share no hash are below the detection limit of the sketches. They are skipped only
+        #if the limit is below the threshold, and the matrix uses the limit, an upper bound of their ANI
+        detection_limit = sketch_detection_limit(args.kmer_size, args.sketch_size)
+
+    #Returns the estimated ANI of the pair if it is skipped by the prescreen, or None
+    def prescreen_pair(reference, query, write_summary=True):
+        distance, estimated_ani = sketch_distance(genome_sketches[reference], genome_sketches[query],
+                                                  args.kmer_size, args.sketch_size)
+        below_detection = estimated_ani is None
+        if below_detection:
+            estimated_ani = detection_limit
+            skip_pair = detection_limit <= args.prescreen_ani
+        else:
+            skip_pair = estimated_ani < args.prescreen_ani
+
+        if write_summary:
+            status = "skipped" if skip_pair else "computed"
+            if below_detection:
+                prescreen_summary.write("%s\t%s\tNA\t<%s\t%s, below detection\n" % (reference, query, estimated_ani,
+                                                                                 status))
+            else:
+                prescreen_summary.write("%s\t%s\t%s\t%s\t%s\n" % (reference, query, distance, estimated_ani, status))
+
+        return estimated_ani if skip_pair else None
+
+    #Distance matrix, filled as the pairs arrive, in place in the .npy file when it is memory mapped, and
+    #the cells of the pairs skipped by the prescreen, which hold the estimated ANI
+    if not args.no_matrix:
+        matrix_npy = args.output_directory + "/matrix_file.npy"
+        rows, cols, ani_array = create_distance_matrix(genome_names, matrix_npy if args.matrix_memmap else None)
+        if args.prescreen_ani is not None:
+            estimated_array = np.zeros(ani_array.shape, dtype=bool)
+
+    #Clusters built as the pairs arrive. In the order of the permutations, the first direction of
+    #each pair is the one with the reference first in the genome list
+    species_clusters = SpeciesClusters(genome_names, args.cluster_ani) if args.cluster_ani is not None else None
+    genome_order = {genome: genome_number for genome_number, genome in enumerate(genome_info.keys())}
+
+    def add_pair_ani(genome_pair, ani):
+        if not args.no_matrix:
+            add_pair_distance(ani_array, rows, genome_pair, ani, not args.one_direction)
+        if species_clusters is not None:
+            if args.one_direction:
+                species_clusters.add_ani(genome_pair, ani)
+            else:
+                first_half = genome_order[genome_pair[0]] < genome_order[genome_pair[1]]
+                species_clusters.add_half(genome_pair, ani, first_half)
+
+    def output_pair(genome_pair, ani_values):
+        reference, query = genome_pair
+        log_text, results, reference_query_ani = format_pair_results(genome_pair, genome_stats[reference],
+                                                                     genome_stats[query], ani_values)
+        log_output.write(log_text)
+
+        #Store the results
+        add_pair_ani(genome_pair, reference_query_ani)
+
+        mapping_summary.write("\t".join(results) + "\n")
+
+    def pair_task(pair_number, reference, query):
+        if args.backend == "kmer":
+            #The k-mer mapping is fast and runs in a single thread, one pair in each process of the pool
+            #Pairs out of its range are computed with blastn, in their own work folder
+            return (reference, query, genome_kmer_index[reference], genome_fragments[query],
+                    args.fragment_kmer_size, genome_info[reference], database_cache, genome_hash[reference],
+                    temp_folder + "/pair_%d" % pair_number, blast_threads, args.stream_blast, args.vectorized)
+        #Each pair with its own work folder
+        return (reference, query, genome_database[reference], genome_fragments[query],
+                temp_folder + "/pair_%d" % pair_number, blast_threads, args.stream_blast, args.vectorized,
+                genome_exact_index[reference])
+
+    pair_function = run_genome_pair_kmer if args.backend == "kmer" else run_genome_pair
+
+    #Completed pairs of the interrupted run, indexed on disk, if the run is resumed
+    checkpoint_index = None
+    if args.resume and os.path.isfile(checkpoint_file):
+        checkpoint_index = index_checkpoint(checkpoint_file, pair_parameters, temp_folder + "/checkpoint.sqlite")
+    checkpoint = open_checkpoint(checkpoint_file, pair_parameters, args.resume)
+
+    #Each pair is looked up in the checkpoint, the results store and the prescreen when its turn comes,
+    #so nothing is kept for every pair. The pairs left are "missing", with their number in the plan
+    def plan_pairs():
+        for pair_number, (reference, query) in enumerate(genome_combinations, 1):
+            genome_pair = (reference, query)
+            genome_hashes = (genome_hash[reference], genome_hash[query])
+
+            #The prescreen summary has each pair once, from its first direction
+            estimated_ani = None
+            if args.prescreen_ani is not None:
+                estimated_ani = prescreen_pair(reference, query, args.one_direction or
+                                               genome_order[reference] < genome_order[query])
+
+            ani_values = None
+            if checkpoint_index is not None:
+                ani_values = load_checkpoint_pair(checkpoint_index, genome_pair, genome_hashes)
+                if ani_values is not None:
+                    yield genome_pair, "checkpoint", ani_values
+                    continue
+            if not args.recompute:
+                ani_values = load_pair_result(results_store, genome_hashes[0], genome_hashes[1], pair_parameters)
+                if ani_values is not None:
+                    yield genome_pair, "stored", ani_values
+                    continue
+            if estimated_ani is not None:
+                yield genome_pair, "estimated", estimated_ani
+                continue
+
+            yield genome_pair, "missing", pair_number
+
+    def save_computed_pair(genome_pair, ani_values):
+        genome_hashes = (genome_hash[genome_pair[0]], genome_hash[genome_pair[1]])
+        save_pair_result(results_store, genome_hashes[0], genome_hashes[1], pair_parameters, ani_values)
+        write_checkpoint(checkpoint, genome_pair, genome_hashes, ani_values)
+
+    #The results of the all vs all and the work queue modes arrive out of order, and are saved as they
+    #arrive, so none is lost if the run is interrupted before their turn in the output
+    def save_received_results(pair_results):
+        for computed_pair, ani_values, timing_record in pair_results:
+            save_computed_pair(computed_pair, ani_values)
+            yield computed_pair, ani_values, timing_record
+
+    if args.all_vs_all or args.queue_directory is not None:
+        planned_pairs = list(plan_pairs())
+        missing_pairs = set(genome_pair for genome_pair, status, value in planned_pairs if status == "missing")
+
+        if args.all_vs_all:
+            #A single database with all the genomes, and one blast for each query with missing pairs
+            combined_hash = "combined_seqids_" + combined_genome_hash([genome_hash[genome] for genome in genome_names])
+            stage_timer = StageTimer(task="combined_database")
+            with stage_timer.stage("makeblastdb"):
+                combined_database = make_combined_database([genome_info[genome] for genome in genome_names],
+                                                           database_cache, combined_hash, temp_folder)
+            write_timing_record(timing_output, timing_summary, stage_timer.record)
+            max_target_seqs = sum(genome_stats[genome].contigs for genome in genome_names)
+
+            missing_queries = set(query for reference, query in missing_pairs)
+            query_tasks = [(query, genome_names, combined_database, max_target_seqs, genome_fragments[query],
+                            temp_folder + "/query_%d" % query_number, blast_threads, args.stream_blast)
+                           for query_number, query in enumerate(genome_names, 1) if query in missing_queries]
+
+            if pool is not None:
+                query_results = pool.imap(run_all_vs_all_query, query_tasks)
+            else:
+                query_results = (run_all_vs_all_query(query_task) for query_task in query_tasks)
+
+            pair_results = flatten_query_results(query_results, missing_pairs)
+
+        else:
+            #Queue the missing pairs for the workers, with the paths to the shared cache. Pairs of genomes
+            #with the same content share a task, and get its result with their own names
+            make_work_queue(args.queue_directory)
+            queue_tasks = []
+            task_pairs = {}
+            for genome_pair, status, value in planned_pairs:
+                if status != "missing":
+                    continue
+                reference, query = genome_pair
+                task_name = pair_task_name(genome_hash[reference], genome_hash[query], pair_parameters)
+                if task_name in task_pairs:
+                    task_pairs[task_name].append(genome_pair)
+                    continue
+                task_pairs[task_name] = [genome_pair]
+                queue_tasks.append((task_name, {"reference": reference, "query": query,
+                                                "reference_database": os.path.abspath(genome_database[reference]),
+                                                "query_fragments": os.path.abspath(genome_fragments[query]),
+                                                "stream_blast": args.stream_blast, "vectorized": args.vectorized,
+                                                "exact_index": genome_exact_index[reference]}))
+            enqueue_pair_tasks(args.queue_directory, queue_tasks)
+            sys.stderr.write("%d pairs queued in %s\n" % (len(queue_tasks), args.queue_directory))
+
+            queue_results = collect_queue_results(args.queue_directory, [task_name for task_name, _ in queue_tasks],
+                                                  args.claim_timeout, args.poll_interval)
+            pair_results = fan_out_queue_results(queue_results, task_pairs)
+
+        finished_pairs = collect_planned_pairs(planned_pairs, save_received_results(pair_results))
+        results_saved = True
+    else:
+        #Results are returned in the order of the pairs, so the output is the same as a serial run
+        planned_tasks = ((genome_pair, status, pair_task(value, *genome_pair) if status == "missing" else value)
+                         for genome_pair, status, value in plan_pairs())
+        finished_pairs = run_planned_pairs(planned_tasks, pair_function, pool)
+        results_saved = False
+
+    pair_counts = dict.fromkeys(["checkpoint", "stored", "estimated", "missing"], 0)
+    for genome_pair, status, ani_values, timing_record in finished_pairs:
+        pair_counts[status] += 1
+        if timing_record is not None:
+            write_timing_record(timing_output, timing_summary, timing_record)
+
+        if status == "estimated":
+            #Not computed, the matrix and the clusters use the estimated ANI
+            add_pair_ani(genome_pair, ani_values)
+            if not args.no_matrix:
+                estimated_array[rows[genome_pair[0]], rows[genome_pair[1]]] = True
+                if args.one_direction:
+                    estimated_array[rows[genome_pair[1]], rows[genome_pair[0]]] = True
+            continue
+
+        if status == "missing" and not results_saved:
+            save_computed_pair(genome_pair, ani_values)
+        elif status == "stored":
+            write_checkpoint(checkpoint, genome_pair, (genome_hash[genome_pair[0]], genome_hash[genome_pair[1]]),
+                             ani_values)
+
+        output_pair(genome_pair, ani_values)
+
+    if checkpoint_index is not None:
+        checkpoint_index.close()
+
+    sys.stderr.write("%d pairs: %d from the checkpoint, %d from the results store, %d skipped by the prescreen, "
+                     "%d computed\n" % (sum(pair_counts.values()), pair_counts["checkpoint"], pair_counts["stored"],
+                                        pair_counts["estimated"], pair_counts["missing"]))
+
+    if args.prescreen_ani is not None:
+        prescreen_summary.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    results_store.close()
+    checkpoint.close()
+    timing_output.close()
+    write_timing_report(timing_summary, args.output_directory + "/timing_report.txt")
+
+    #Save the clusters
+    if species_clusters is not None:
+        genome_clusters = species_clusters.clusters()
+        write_clusters(args.output_directory + "/clusters.txt", genome_clusters, args.cluster_ani)
+        sys.stderr.write("%d clusters at an ANI of %s\n" % (len(genome_clusters), args.cluster_ani))
+
+    #Close final files
+    log_output.close()
+    mapping_summary.close()
+
+    if args.no_matrix:
+        shutil.rmtree(temp_folder)
+        sys.exit(0)
+
+    order_col_labels = sorted(cols, key=cols.get)
+
+    #Save matrix file, as a table and as a binary .npy with the names in matrix_labels.txt
+    write_matrix_file(args.output_directory + "/matrix_file.txt", order_col_labels, ani_array,
+                      "one-directional ANI" if args.one_direction else "")
+
+    if args.matrix_memmap:
+        ani_array.flush()
+    else:
+        np.save(matrix_npy, ani_array)
+
+    with open(args.output_directory + "/matrix_labels.txt", 'w') as matrix_labels:
+        matrix_labels.write("\n".join(order_col_labels) + "\n")
+
+    #Save the cells of the pairs skipped by the prescreen
+    if args.prescreen_ani is not None:
+        write_matrix_file(args.output_directory + "/matrix_estimated.txt", order_col_labels, estimated_array,
+                          "estimated", "%d")
+        np.save(args.output_directory + "/matrix_estimated.npy", estimated_array)
+
+    #Run hierarchical analysis and save the plot
+    if not args.no_dendrogram:
+        distance_matrix = scipy.spatial.distance.squareform(ani_array)
+        linkage_matrix = sch.linkage(distance_matrix, method="complete", metric="euclidean")  # Method and metric
+        X = sch.dendrogram(linkage_matrix, labels=order_col_labels, orientation="left")
+
+        plt.subplots_adjust(left=0.3)
+        plt.savefig(args.output_directory + "/ANI_hier_plot.pdf")
 
     #Remove the temporal folder
     shutil.rmtree(temp_folder)
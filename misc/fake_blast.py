@@ -0,0 +1,250 @@
+#!/usr/local/bin/python3
+# fake_blast.py
+# Deterministic stand-in for makeblastdb and blastn, to benchmark ANI_blastn.py
+# without BLAST+. Install it with ANI_benchmark.py --end_to_end, or call it as
+# "fake_blast.py makeblastdb ..." and "fake_blast.py blastn ...".
+#
+# makeblastdb copies the fasta next to the database name. blastn anchors each
+# query with k-mers of the database, extends the best diagonal of each subject
+# sequence without gaps on both strands and writes outfmt 6 lines for the best
+# subjects, up to -max_target_seqs: the top hit of each one plus a shorter,
+# weaker hit, so the top hit parsing has work to do.
+#
+# Created on 16 Oct 2026
+from __future__ import print_function, absolute_import, division
+import sys
+import os
+import math
+import shutil
+
+
+###############################################################################
+# FUNCTION DEFINITIONS
+###############################################################################
+ANCHOR_SIZE = 16  # Size of the k-mers used to place a query on the database
+ANCHOR_STEP = 25  # Distance between the anchors taken from each query
+MAX_TARGET_SEQS = 500  # Subject sequences reported for each query, as blastn
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def read_fasta(fasta_file):
+    """
+    Read a fasta file.
+
+    :param fasta_file: Fasta file path
+    :type fasta_file: str
+    :return: Sequence IDs and sequences, in the order of the file
+    :rtype: list
+    """
+    records = []
+    name = None
+    sequence = []
+    with open(fasta_file, 'r') as f:
+        for l in f:
+            l = l.strip()
+            if l.startswith('>'):
+                if name is not None:
+                    records.append((name, ''.join(sequence)))
+                name = l[1:].split()[0]
+                sequence = []
+            else:
+                sequence.append(l.upper())
+    if name is not None:
+        records.append((name, ''.join(sequence)))
+    return records
+
+
+def reverse_complement(sequence):
+    """
+    Return the reverse complement of a DNA sequence.
+    """
+    return ''.join(COMPLEMENT.get(base, 'N') for base in reversed(sequence))
+
+
+def index_subjects(subjects):
+    """
+    Index the first position of every k-mer in each subject sequence.
+
+    :param subjects: Subject IDs and sequences
+    :type subjects: list
+    :return: K-mer to list of (subject number, position)
+    :rtype: dict
+    """
+    kmer_index = {}
+    for subject_number, (name, sequence) in enumerate(subjects):
+        seen = set()
+        for position in range(len(sequence) - ANCHOR_SIZE + 1):
+            kmer = sequence[position:position + ANCHOR_SIZE]
+            if kmer not in seen:
+                seen.add(kmer)
+                kmer_index.setdefault(kmer, []).append((subject_number,
+                                                        position))
+    return kmer_index
+
+
+def score_alignment(matches, mismatches, search_space):
+    """
+    Bit score and e-value of an ungapped alignment, with reward 1 and
+    penalty -1.
+    """
+    raw_score = matches - mismatches
+    bit_score = max(0.0, (1.28 * raw_score + 0.46) / math.log(2))
+    evalue = search_space * 2.0 ** -bit_score
+    return bit_score, evalue
+
+
+def align_diagonal(query, subject, offset):
+    """
+    Compare the query with the subject without gaps, with the query starting
+    at offset of the subject. The ends are trimmed to the first and last match.
+
+    :return: 0-based query start and end, matches and mismatches, or None
+    :rtype: tuple
+    """
+    start = max(0, -offset)
+    end = min(len(query), len(subject) - offset)
+    if end - start < ANCHOR_SIZE:
+        return None
+
+    matched = [i for i in range(start, end)
+               if query[i] == subject[i + offset]]
+    if not matched:
+        return None
+    first, last = matched[0], matched[-1]
+    matches = len(matched)
+    return first, last, matches, (last - first + 1) - matches
+
+
+def blast_query(query_name, query, subjects, kmer_index, search_space,
+                max_target_seqs=MAX_TARGET_SEQS):
+    """
+    Find the best ungapped hit of the query on each strand of each subject,
+    and keep the max_target_seqs subjects with the best hits. Yields outfmt 6
+    lines, the best subject first, and for each hit the top hit and then a
+    shorter hit on the same diagonal.
+    """
+    subject_hits = {}
+    for strand, sequence in ((1, query), (-1, reverse_complement(query))):
+        # Vote for the diagonals of each subject with the anchors of the query
+        votes = {}
+        for position in range(0, len(sequence) - ANCHOR_SIZE + 1,
+                              ANCHOR_STEP):
+            anchors = kmer_index.get(sequence[position:position + ANCHOR_SIZE],
+                                     ())
+            for subject_number, subject_position in anchors:
+                diagonal = (subject_number, subject_position - position)
+                votes[diagonal] = votes.get(diagonal, 0) + 1
+
+        # Best voted diagonal of each subject, ties go to the first position
+        best_diagonals = {}
+        for diagonal in sorted(votes, key=lambda d: (-votes[d], d)):
+            best_diagonals.setdefault(diagonal[0], diagonal[1])
+
+        for subject_number, offset in best_diagonals.items():
+            alignment = align_diagonal(sequence, subjects[subject_number][1],
+                                       offset)
+            if alignment is None:
+                continue
+            subject_hits.setdefault(subject_number, []).append(
+                (strand, offset, alignment))
+
+    # Subjects with the best hit first, ties go to the first subject
+    def best_score(subject_number):
+        return max(matches - mismatches for strand, offset,
+                   (first, last, matches, mismatches)
+                   in subject_hits[subject_number])
+    ranked_subjects = sorted(subject_hits,
+                             key=lambda n: (-best_score(n), n))
+
+    hits = [(strand, subjects[subject_number][0], offset, alignment)
+            for subject_number in ranked_subjects[:max_target_seqs]
+            for strand, offset, alignment in subject_hits[subject_number]]
+
+    for strand, subject_name, offset, alignment in hits:
+        first, last, matches, mismatches = alignment
+        # The second hit covers the first half of the top hit
+        half = first + (last - first) // 2
+        half_matches = (matches * (half - first + 1)) // (last - first + 1)
+        for hit_first, hit_last, hit_matches in ((first, last, matches),
+                                                 (first, half, half_matches)):
+            length = hit_last - hit_first + 1
+            hit_mismatches = length - hit_matches
+            bit_score, evalue = score_alignment(hit_matches, hit_mismatches,
+                                                search_space)
+            identity = 100.0 * hit_matches / length
+            if strand == 1:
+                query_start, query_end = hit_first + 1, hit_last + 1
+                subject_start = hit_first + offset + 1
+                subject_end = hit_last + offset + 1
+            else:
+                query_start = len(query) - hit_last
+                query_end = len(query) - hit_first
+                subject_start = hit_last + offset + 1
+                subject_end = hit_first + offset + 1
+            yield '\t'.join([query_name, subject_name, '%.2f' % identity,
+                             str(length), str(hit_mismatches), '0',
+                             str(query_start), str(query_end),
+                             str(subject_start), str(subject_end),
+                             '%.2e' % evalue, '%.1f' % bit_score]) + '\n'
+
+
+def blast_fragments(queries, subjects, max_target_seqs=MAX_TARGET_SEQS):
+    """
+    Blast the query sequences against the subject sequences.
+
+    :param queries: Query IDs and sequences
+    :type queries: list
+    :param subjects: Subject IDs and sequences
+    :type subjects: list
+    :param max_target_seqs: Subject sequences reported for each query
+    :type max_target_seqs: int
+    :return: outfmt 6 lines
+    :rtype: generator
+    """
+    kmer_index = index_subjects(subjects)
+    database_size = sum(len(sequence) for name, sequence in subjects)
+    for query_name, query in queries:
+        for line in blast_query(query_name, query.upper(), subjects,
+                                kmer_index, len(query) * database_size,
+                                max_target_seqs):
+            yield line
+
+
+def get_option(arguments, option, default=None):
+    """
+    Return the value that follows an option in the command line.
+    """
+    if option in arguments:
+        return arguments[arguments.index(option) + 1]
+    return default
+
+
+###############################################################################
+# BEGIN PROCESSING
+###############################################################################
+if __name__ == '__main__':
+    # The program is the name it was called with, or the first argument
+    program = os.path.basename(sys.argv[0])
+    arguments = sys.argv[1:]
+    if program not in ('makeblastdb', 'blastn'):
+        if not arguments or arguments[0] not in ('makeblastdb', 'blastn'):
+            sys.exit('Usage: fake_blast.py makeblastdb|blastn [options]')
+        program = arguments.pop(0)
+
+    if program == 'makeblastdb':
+        database = get_option(arguments, '-out')
+        shutil.copy(get_option(arguments, '-in'), database + '.fna')
+        # Marker file, like the index of a real nucleotide database
+        open(database + '.nin', 'w').close()
+
+    else:
+        subjects = read_fasta(get_option(arguments, '-db') + '.fna')
+        queries = read_fasta(get_option(arguments, '-query'))
+        output_file = get_option(arguments, '-out')
+        output = open(output_file, 'w') if output_file else sys.stdout
+        max_target_seqs = int(get_option(arguments, '-max_target_seqs',
+                                         MAX_TARGET_SEQS))
+        for line in blast_fragments(queries, subjects, max_target_seqs):
+            output.write(line)
+        if output_file:
+            output.close()
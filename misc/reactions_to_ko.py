@@ -11,9 +11,23 @@ import os
 import time
 import datetime
 import argparse
+import threading
+import io
+import json
+import sqlite3
 import PyFBA
-import requests
 import re
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+# The HTTP session, response cache and KEGG batch requests are shared with
+# kegg_api/reactions_to_kegg.py, which uses the same cache file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'kegg_api'))
+from rest_client import (add_session_arguments, make_session_from_args,
+                         open_cache_from_args, session_get,
+                         fetch_kegg_entries)
 
 
 ###############################################################################
@@ -52,9 +66,258 @@ def exit_script(num=1):
     sys.exit(num)
 
 
+class RateLimiter(object):
+    """
+    Limit the number of requests per second sent to each host, shared by
+    all threads. Each request waits for the next free slot of its host.
+    """
+    def __init__(self, host_rates, default_rate):
+        """
+        :param host_rates: Requests per second allowed for each host
+        :type host_rates: dict
+        :param default_rate: Requests per second for any other host
+        :type default_rate: float
+        """
+        self.host_rates = host_rates
+        self.default_rate = default_rate
+        self.next_slot = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Block until a request to the host of the URL is allowed.
+
+        :param url: Request URL
+        :type url: str
+        """
+        host = urlparse(url).netloc
+        interval = 1 / self.host_rates.get(host, self.default_rate)
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + interval
+            self.requests[host] = self.requests.get(host, 0) + 1
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class CachedResponse(object):
+    """
+    Response read from the response cache, with the attributes of
+    requests.Response used by this script.
+    """
+    def __init__(self, text):
+        self.status_code = 200
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class KeggLinkTables(object):
+    """
+    Local copy of KEGG link tables, downloaded in bulk with the link
+    operation of the KEGG API and stored in SQLite, indexed by source ID.
+    Each table keeps the time it was downloaded, to refresh it once it is
+    older than the maximum age.
+    """
+    def __init__(self, link_file, max_age_days):
+        """
+        :param link_file: SQLite file path
+        :type link_file: str
+        :param max_age_days: Days before a table is downloaded again
+        :type max_age_days: float
+        """
+        self.max_age = max_age_days * 86400
+        self.db = sqlite3.connect(link_file)
+        self.db.execute('CREATE TABLE IF NOT EXISTS link_tables ('
+                        'target_db TEXT, source_db TEXT, fetched REAL, '
+                        'PRIMARY KEY (target_db, source_db))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS links ('
+                        'target_db TEXT, source_db TEXT, '
+                        'source TEXT, target TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS links_source '
+                        'ON links (target_db, source_db, source)')
+        self.db.commit()
+
+    def age(self, target_db, source_db):
+        """
+        Return the age of a table in days, or None if it was never downloaded.
+
+        :param target_db: Target database, like ko
+        :type target_db: str
+        :param source_db: Source database, like reaction
+        :type source_db: str
+        :return: Age in days
+        :rtype: float
+        """
+        row = self.db.execute('SELECT fetched FROM link_tables '
+                              'WHERE target_db = ? AND source_db = ?',
+                              (target_db, source_db)).fetchone()
+        if row is None:
+            return None
+        return (time.time() - row[0]) / 86400
+
+    def is_current(self, target_db, source_db):
+        """
+        Check if a table was downloaded and is not older than the maximum age.
+        """
+        age = self.age(target_db, source_db)
+        return age is not None and age * 86400 <= self.max_age
+
+    def store(self, target_db, source_db, text):
+        """
+        Replace a table with the text of a link response. Each line has a
+        source ID and a target ID separated by a tab, both with a database
+        prefix, like rn:R00001 and ko:K01061. Prefixes are removed.
+
+        :param target_db: Target database, like ko
+        :type target_db: str
+        :param source_db: Source database, like reaction
+        :type source_db: str
+        :param text: API response text
+        :type text: str
+        :return: Number of links
+        :rtype: int
+        """
+        links = []
+        for line in text.split('\n'):
+            fields = line.split('\t')
+            if len(fields) < 2:
+                continue
+            links.append((target_db, source_db,
+                          fields[0].split(':')[-1], fields[1].split(':')[-1]))
+
+        self.db.execute('DELETE FROM links '
+                        'WHERE target_db = ? AND source_db = ?',
+                        (target_db, source_db))
+        self.db.executemany('INSERT INTO links VALUES (?, ?, ?, ?)', links)
+        self.db.execute('INSERT OR REPLACE INTO link_tables VALUES (?, ?, ?)',
+                        (target_db, source_db, time.time()))
+        self.db.commit()
+        return len(links)
+
+    def load(self, target_db, source_db):
+        """
+        Load a table in memory.
+
+        :param target_db: Target database, like ko
+        :type target_db: str
+        :param source_db: Source database, like reaction
+        :type source_db: str
+        :return: Source ID to target IDs
+        :rtype: dict
+        """
+        links = {}
+        rows = self.db.execute('SELECT source, target FROM links '
+                               'WHERE target_db = ? AND source_db = ?',
+                               (target_db, source_db))
+        for source, target in rows:
+            if source not in links:
+                links[source] = set()
+            links[source].add(target)
+        return links
+
+    def close(self):
+        self.db.close()
+
+
+def progress_map(executor, label, function, items):
+    """
+    Map a function over the items in the thread pool, printing the progress
+    as each call completes. Results are returned in the order of the items,
+    like the map of the pool.
+
+    :param executor: Thread pool
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param label: Name of the items in the progress line
+    :type label: str
+    :param function: Function called with each item
+    :type function: function
+    :param items: Items
+    :type items: list
+    :return: Results
+    :rtype: list
+    """
+    futures = [executor.submit(function, item) for item in items]
+    for i, future in enumerate(as_completed(futures), start=1):
+        print('Fetched', str(i), 'of', str(len(futures)), label,
+              end='\r', file=sys.stderr)
+    if futures:
+        print('', file=sys.stderr)
+    return [future.result() for future in futures]
+
+
+def rate_limited_get(url):
+    """
+    Issue a GET request once the rate limiter of the host allows it. A request
+    that fails without a response returns a FailedResponse.
+
+    :param url: Request URL
+    :type url: str
+    :return: API response
+    :rtype: requests.Response or FailedResponse
+    """
+    RATE_LIMITER.wait(url)
+    return session_get(SESSION, url, TIMEOUT)
+
+
+def cached_get(endpoint, entry_id):
+    """
+    Issue a GET request for an entry of an endpoint, reading through the
+    response cache. Only successful responses are cached.
+
+    :param endpoint: API endpoint URL
+    :type endpoint: str
+    :param entry_id: Entry ID
+    :type entry_id: str
+    :return: API response
+    :rtype: requests.Response or CachedResponse
+    """
+    if RESPONSE_CACHE is not None:
+        body = RESPONSE_CACHE.get(endpoint, entry_id)
+        if body is not None:
+            return CachedResponse(body)
+
+    response = rate_limited_get(os.path.join(endpoint, entry_id))
+    if RESPONSE_CACHE is not None and response.status_code == 200:
+        RESPONSE_CACHE.put(endpoint, entry_id, response.text)
+    return response
+
+
+def lookup_kegg_kos(ko):
+    """
+    Return the parsed entry of a KEGG ID, or its links in offline mode. Each
+    entry is parsed the first time it is looked up, and reused for every
+    other reaction with the same ID.
+
+    :param ko: KEGG ID
+    :type ko: str
+    :return: Status code, whether the response was empty, and the KO IDs, or
+    None if the entry has no ORTHOLOGY info
+    :rtype: tuple
+    """
+    if ko not in KO_MEMO:
+        if LINKED_KOS is not None:
+            # Offline, KEGG reaction IDs and EC numbers are joined with the
+            # link tables. IDs without links have no ORTHOLOGY info
+            kos = LINKED_KOS.get(ko.split(':')[-1])
+            KO_MEMO[ko] = (200, False, set(kos) if kos else None)
+        else:
+            status_code, text = KEGG_ENTRIES[ko]
+            empty = text.strip('\n') == ''
+            kos = None
+            if status_code == 200 and not empty:
+                kos = parse_kegg_response(text)
+            KO_MEMO[ko] = (status_code, empty, kos)
+    return KO_MEMO[ko]
+
+
 def make_kegg_query(ms, ko, log, save_kos):
     """
-    Setup a query to the KEGG API
+    Setup a query to the KEGG API. The entry was fetched before by
+    fetch_kegg_entries, or is resolved from the link tables in offline mode.
 
     :param ms: ModelSEED reaction ID
     :type ms: str
@@ -66,31 +329,33 @@ def make_kegg_query(ms, ko, log, save_kos):
     :type save_kos: set
     :return: None
     """
-    # Set resource path
-    resource = 'get/' + ko
+    LOOKUP_COUNTS['KEGG'] += 1
 
-    # Issue request
-    full_path = os.path.join(KEGG_BASE_URL, resource)
-    response = requests.get(full_path)
+    # Look up parsed response
+    status_code, empty, kos = lookup_kegg_kos(ko)
 
     # Check that status code is 200 = good
-    if response.status_code != 200:
+    if status_code != 200:
         log.write('There was an error with the request '
                   'regarding ModelSEED reaction ' + ms
                   + ' and KO ' + ko + ', status code = '
-                  + str(response.status_code) + '\n')
+                  + str(status_code) + '\n')
         return
 
     # Check that response is not empty
-    elif response.text.strip('\n') == '':
+    elif empty:
         log.write('Response was empty for KO ' + ko + '\n')
         return
 
-    # Parse response
-    parse_kegg_response(response.text, ms, ko, log, save_kos)
+    # Check if response contains KO info
+    elif kos is None:
+        log.write('No ORTHOLOGY info for ' + ms + ':' + ko + '\n')
+        return
 
+    save_kos.update(kos)
 
-def parse_kegg_response(res, ms, ko, log, save_kos):
+
+def parse_kegg_response(res):
     """
     Parse the KEGG API response text. Text is all plain text without an
     easily digestible format. Feature headers are listed at the beginning of
@@ -107,24 +372,17 @@ def parse_kegg_response(res, ms, ko, log, save_kos):
 
     :param res: API response text
     :type res: str
-    :param ms: ModelSEED reaction ID
-    :type ms: str
-    :param ko: KEGG KO ID
-    :type ko: str
-    :param log: Log output file handle
-    :type log: File
-    :param save_kos: Set to add KO IDs to
-    :type save_kos: set
-    :return: None
+    :return: KO IDs, or None if there is no ORTHOLOGY info
+    :rtype: set
     """
     # Check if response contains KO info
     if not re.search(r'ORTHOLOGY', res):
-        log.write('No ORTHOLOGY info for ' + ms + ':' + ko + '\n')
-        return False
+        return None
 
     # Response contains newlines
     res = res.rstrip().split('\n')
 
+    kos = set()
     curr_section = ''
     for line in res:
         # First 12 characters contain SECTION
@@ -136,7 +394,67 @@ def parse_kegg_response(res, ms, ko, log, save_kos):
 
         if curr_section == 'ORTHOLOGY':
             ko_id = re.match(r'K\d+', kegg_data).group(0)
-            save_kos.add(ko_id)
+            kos.add(ko_id)
+    return kos
+
+
+def update_link_table(target_db, source_db, refresh=False):
+    """
+    Download a KEGG link table with a single request, unless the stored copy
+    is current. If the download fails, an older copy is still used.
+
+    :param target_db: Target database, like ko
+    :type target_db: str
+    :param source_db: Source database, like reaction
+    :type source_db: str
+    :param refresh: Download the table even if it is current
+    :type refresh: bool
+    :return: Whether the table is available
+    :rtype: bool
+    """
+    name = 'link/' + target_db + '/' + source_db
+    if not refresh and LINK_TABLES.is_current(target_db, source_db):
+        return True
+
+    if args.verbose:
+        print_status('Downloading KEGG table ' + name)
+    response = rate_limited_get(os.path.join(KEGG_BASE_URL, name))
+    if response.status_code != 200:
+        print_status('There was an error downloading KEGG table ' + name
+                     + ', status code = ' + str(response.status_code))
+        age = LINK_TABLES.age(target_db, source_db)
+        if age is None:
+            return False
+        print_status('Using the copy from ' + str(round(age, 1))
+                     + ' days ago')
+        return True
+
+    n_links = LINK_TABLES.store(target_db, source_db, response.text)
+    if args.verbose:
+        print_status('KEGG table ' + name + ' has ' + str(n_links) + ' links')
+    return True
+
+
+def fetch_bigg_entry(bi):
+    """
+    Get the BiGG universal reaction of a BiGG ID. Offline, the entry is only
+    read from the response cache, whatever its age.
+
+    :param bi: BiGG reaction ID
+    :type bi: str
+    :return: Status code and response text, or None and an empty text if the
+    entry is not cached offline
+    :rtype: tuple
+    """
+    endpoint = os.path.join(BIGG_BASE_URL, 'universal/reactions')
+    if args.offline:
+        text = RESPONSE_CACHE.get(endpoint, bi, any_age=True)
+        if text is None:
+            return None, ''
+        return 200, text
+
+    response = cached_get(endpoint, bi)
+    return response.status_code, response.text
 
 
 def make_bigg_query(ms, bi, log):
@@ -152,28 +470,32 @@ def make_bigg_query(ms, bi, log):
     :return: KO IDs and EC numbers
     :rtype: dict
     """
-    # Set resource path
-    resource = 'universal/reactions/' + bi
+    LOOKUP_COUNTS['BiGG'] += 1
+
+    # Look up response, fetched before by fetch_bigg_entry
+    status_code, text = BIGG_ENTRIES[bi]
 
-    # Issue request
-    full_path = os.path.join(BIGG_BASE_URL, resource)
-    response = requests.get(full_path)
+    # Check that the entry was cached before an offline run
+    if status_code is None:
+        log.write('BiGG ' + bi + ' of ModelSEED reaction ' + ms
+                  + ' is not in the response cache. Skipping offline\n')
+        return None
 
     # Check that status code is 200 = good
-    if response.status_code != 200:
+    elif status_code != 200:
         log.write('There was an error with the request '
                   'regarding ModelSEED reaction ' + ms
                   + ' and BiGG ' + bi + ', status code = '
-                  + str(response.status_code) + '\n')
+                  + str(status_code) + '\n')
         return None
 
     # Check that response is not empty
-    elif response.text.strip('\n') == '':
+    elif text.strip('\n') == '':
         log.write('Response was empty for BiGG ' + bi + '\n')
         return None
 
     # Parse response
-    return parse_bigg_response(response.json(), ms, bi, log)
+    return parse_bigg_response(json.loads(text), ms, bi, log)
 
 
 def parse_bigg_response(res, ms, bi, log):
@@ -225,6 +547,90 @@ def parse_bigg_response(res, ms, bi, log):
     return data
 
 
+def plan_reaction(mseed_rxn):
+    """
+    Read the BiGG entries of the aliases of a model reaction, and list the
+    steps to process it in order: log text and KEGG queries. KEGG entries of
+    all reactions are fetched together afterwards, in batches.
+
+    :param mseed_rxn: ModelSEED reaction ID
+    :type mseed_rxn: str
+    :return: Steps, ('log', text) or ('kegg', KEGG ID)
+    :rtype: list
+    """
+    plan = []
+
+    # Check if reaction exists in alias dictionary
+    if mseed_rxn not in aliases:
+        plan.append(('log', mseed_rxn + ' not in alias file\n'))
+        return plan
+
+    # Get databases
+    for db in aliases[mseed_rxn]:
+        #######################################
+        # METACYC & PLANTCYC
+        #######################################
+        if db == 'MetaCyc' or db == 'PlantCyc':
+            plan.append(('log', mseed_rxn + ' database is ' + db
+                         + '. Skipping\n'))
+
+        #######################################
+        # KEGG
+        #######################################
+        elif db == 'KEGG':
+            # May have multiple KO identifiers
+            for ko in sorted(aliases[mseed_rxn][db]):
+                plan.append(('kegg', ko))
+
+        #######################################
+        # BIGG
+        #######################################
+        elif db == 'BiGG':
+            # May have multiple BiGG identifiers
+            for bigg in sorted(aliases[mseed_rxn][db]):
+                # Get dictionary of KO IDs and EC numbers
+                log = io.StringIO()
+                bigg_info = make_bigg_query(mseed_rxn, bigg, log)
+                plan.append(('log', log.getvalue()))
+                if bigg_info == None:
+                    continue
+
+                # Make queries to KEGG database with KO
+                for ko in sorted(bigg_info['KO']):
+                    plan.append(('kegg', ko))
+
+                # Make queries to KEGG database with EC
+                for ec in sorted(bigg_info['EC']):
+                    plan.append(('kegg', ec))
+
+        else:
+            plan.append(('log', mseed_rxn + ' database is ' + db
+                         + ' and not supported\n'))
+
+    return plan
+
+
+def run_reaction_plan(mseed_rxn, plan):
+    """
+    Process the steps of a model reaction, once the KEGG entries are fetched.
+
+    :param mseed_rxn: ModelSEED reaction ID
+    :type mseed_rxn: str
+    :param plan: Steps of plan_reaction
+    :type plan: list
+    :return: Log text and KO IDs of the reaction
+    :rtype: tuple
+    """
+    log = io.StringIO()
+    rxn_kos = set()
+    for step, value in plan:
+        if step == 'log':
+            log.write(value)
+        else:
+            make_kegg_query(mseed_rxn, value, log, rxn_kos)
+    return log.getvalue(), rxn_kos
+
+
 ###############################################################################
 # ARGUMENT PARSING
 ###############################################################################
@@ -233,10 +639,43 @@ parser = argparse.ArgumentParser(description='Obtain EC and KO values for '
 parser.add_argument('model', help='Model name')
 parser.add_argument('modeldir', help='Model directory')
 parser.add_argument('mseeddir', help='ModelSEED directory')
+parser.add_argument('-t', '--threads', type=int, default=4,
+                    help='Number of reactions queried at the same time '
+                    '[default: 4]')
+parser.add_argument('--kegg_rate', type=float, default=3,
+                    help='Maximum KEGG requests per second [default: 3]')
+parser.add_argument('--bigg_rate', type=float, default=10,
+                    help='Maximum BiGG requests per second [default: 10]')
+add_session_arguments(parser)
+parser.add_argument('--offline', action='store_true',
+                    help='Make no request per entry: resolve KEGG reaction '
+                    'IDs and EC numbers to KO IDs with the bulk KEGG link '
+                    'tables, and read BiGG entries only from the response '
+                    'cache, whatever their age. BiGG entries that were never '
+                    'cached are skipped. Only the link tables are downloaded, '
+                    'when missing or older than --link_max_age')
+parser.add_argument('--link_file',
+                    default=os.path.join(os.path.expanduser('~'),
+                                         '.kegg_link_tables.sqlite'),
+                    help='SQLite copy of the KEGG link tables used with '
+                    '--offline [default: ~/.kegg_link_tables.sqlite]')
+parser.add_argument('--link_max_age', type=float, default=7,
+                    help='Days before the link tables are downloaded again '
+                    '[default: 7]')
+parser.add_argument('--refresh_links', action='store_true',
+                    help='Download the link tables even if they are current')
+parser.add_argument('--pathway_file',
+                    help='With --offline, write the KEGG pathways of each '
+                    'KO ID to this file')
 parser.add_argument('-v', '--verbose', action='store_true',
                     help='Verbose output')
 
 args = parser.parse_args()
+if args.pathway_file and not args.offline:
+    parser.error('--pathway_file requires --offline')
+if args.offline and args.no_cache:
+    parser.error('--offline reads the BiGG entries from the response cache, '
+                 'it can not be used with --no_cache')
 
 # Check that model directory exists
 if not os.path.isdir(args.modeldir):
@@ -265,6 +704,35 @@ if not os.path.isfile(reactions_file):
 KEGG_BASE_URL = 'http://rest.kegg.jp/'
 BIGG_BASE_URL = 'http://bigg.ucsd.edu/api/v2/'
 
+# Requests per second allowed for each host, shared by all threads
+RATE_LIMITER = RateLimiter({urlparse(KEGG_BASE_URL).netloc: args.kegg_rate,
+                            urlparse(BIGG_BASE_URL).netloc: args.bigg_rate},
+                           args.kegg_rate)
+
+# HTTP session shared by all threads, up to one connection per thread and host
+SESSION, TIMEOUT = make_session_from_args(args, max(1, args.threads))
+
+# Open response cache
+try:
+    RESPONSE_CACHE = open_cache_from_args(args)
+except ValueError as e:
+    print_status(str(e))
+    exit_script()
+
+# Load the KEGG link tables, downloading the ones missing or too old
+LINKED_KOS = None  # KEGG reaction ID or EC number to KO IDs, offline only
+if args.offline:
+    LINK_TABLES = KeggLinkTables(args.link_file, args.link_max_age)
+    for target_db, source_db in (('ko', 'reaction'), ('ko', 'ec'),
+                                 ('pathway', 'ko')):
+        if not update_link_table(target_db, source_db, args.refresh_links):
+            print_status('KEGG link tables are not available offline')
+            exit_script()
+    LINKED_KOS = LINK_TABLES.load('ko', 'reaction')
+    LINKED_KOS.update(LINK_TABLES.load('ko', 'ec'))
+    KO_PATHWAYS = LINK_TABLES.load('pathway', 'ko')
+    LINK_TABLES.close()
+
 ###############################################################################
 # BEGIN PROCESSING
 ###############################################################################
@@ -343,59 +811,78 @@ if args.verbose:
 # Create log file
 log_out = open('log.txt', 'w')
 
-# Iterate through model reactions
+# Fetch each distinct BiGG ID once, in parallel, then the KEGG entries of all
+# reactions in batches, unless they are joined with the link tables offline.
+# Logs are written in model order
+KO_MEMO = {}  # KEGG ID to parsed entry, shared by the KEGG and BiGG aliases
+LOOKUP_COUNTS = {'KEGG': 0, 'BiGG': 0}  # Lookups, before deduplication
+with ThreadPoolExecutor(max_workers=max(1, args.threads)) as executor:
+    bigg_ids = sorted(set(bigg for mseed_rxn in model.reactions
+                          if mseed_rxn in aliases
+                          for bigg in aliases[mseed_rxn].get('BiGG', ())))
+    if args.verbose:
+        print_status(('Reading ' if args.offline else 'Fetching ')
+                     + str(len(bigg_ids)) + ' BiGG entries')
+    BIGG_ENTRIES = dict(zip(bigg_ids, progress_map(executor, 'BiGG entries',
+                                                   fetch_bigg_entry,
+                                                   bigg_ids)))
+    plans = [plan_reaction(mseed_rxn) for mseed_rxn in model.reactions]
+
+    kegg_ids = sorted(set(value for plan in plans
+                          for step, value in plan if step == 'kegg'))
+    if args.verbose and not args.offline:
+        print_status('Fetching ' + str(len(kegg_ids)) + ' KEGG entries')
+    if not args.offline:
+        KEGG_ENTRIES = fetch_kegg_entries(kegg_ids, rate_limited_get,
+                                          KEGG_BASE_URL, RESPONSE_CACHE,
+                                          map_function=partial(
+                                              progress_map, executor,
+                                              'KEGG batches'))
+
 if args.verbose:
     print_status('Processing model reactions')
-for i, mseed_rxn in enumerate(model.reactions, start=1):
+for i, (mseed_rxn, plan) in enumerate(zip(model.reactions, plans), start=1):
     print('Processing reaction', str(i), 'of', n_rxns,
           end='\r', file=sys.stderr)
-
-    # Check if reaction exists in alias dictionary
-    if mseed_rxn not in aliases:
-        log_out.write(mseed_rxn + ' not in alias file\n')
-
-    # Get databases
-    for db in aliases[mseed_rxn]:
-        #######################################
-        # METACYC & PLANTCYC
-        #######################################
-        if db == 'MetaCyc' or db == 'PlantCyc':
-            log_out.write(mseed_rxn + ' database is ' + db + '. Skipping\n')
-
-        #######################################
-        # KEGG
-        #######################################
-        elif db == 'KEGG':
-            # May have multiple KO identifiers
-            for ko in aliases[mseed_rxn][db]:
-                make_kegg_query(mseed_rxn, ko, log_out, save_kos)
-
-        #######################################
-        # BIGG
-        #######################################
-        elif db == 'BiGG':
-            # May have multiple BiGG identifiers
-            for bigg in aliases[mseed_rxn][db]:
-                # Get dictionary of KO IDs and EC numbers
-                bigg_info = make_bigg_query(mseed_rxn, bigg, log_out)
-                if bigg_info == None:
-                    continue
-
-                # Make queries to KEGG database with KO
-                for ko in bigg_info['KO']:
-                    make_kegg_query(mseed_rxn, ko, log_out, save_kos)
-
-                # Make queries to KEGG database with EC
-                for ec in bigg_info['EC']:
-                    make_kegg_query(mseed_rxn, ec, log_out, save_kos)
-
-        else:
-            log_out.write(mseed_rxn + ' database is ' + db
-                          + ' and not supported\n')
+    rxn_log, rxn_kos = run_reaction_plan(mseed_rxn, plan)
+    log_out.write(rxn_log)
+    save_kos.update(rxn_kos)
+
+# Deduplication stats
+log_out.write('KEGG lookups: ' + str(LOOKUP_COUNTS['KEGG'])
+              + ', distinct KEGG IDs: ' + str(len(KO_MEMO)) + '\n')
+log_out.write('BiGG lookups: ' + str(LOOKUP_COUNTS['BiGG'])
+              + ', distinct BiGG IDs: ' + str(len(BIGG_ENTRIES)) + '\n')
+n_uncached = sum(1 for status_code, text in BIGG_ENTRIES.values()
+                 if status_code is None)
+if n_uncached:
+    log_out.write('BiGG IDs not in the response cache: ' + str(n_uncached)
+                  + '\n')
+    print_status(str(n_uncached) + ' BiGG entries are not in the response '
+                 'cache and were skipped, run once without --offline to '
+                 'fetch them')
+for host in sorted(RATE_LIMITER.requests):
+    log_out.write('Requests to ' + host + ': '
+                  + str(RATE_LIMITER.requests[host]) + '\n')
 
 ###############################################################################
 # PRINT OUT DATA
 ###############################################################################
 print('\n'.join(save_kos))
 log_out.close()
+
+# Pathways of each KO ID. Every pathway is linked both as a reference map and
+# as a KO map, only the reference maps are kept
+if args.pathway_file:
+    with open(args.pathway_file, 'w') as f:
+        for ko in sorted(save_kos):
+            pathways = sorted(pathway for pathway in KO_PATHWAYS.get(ko, ())
+                              if pathway.startswith('map'))
+            f.write(ko + '\t' + ';'.join(pathways) + '\n')
+if RESPONSE_CACHE is not None:
+    if args.verbose:
+        print_status('Response cache: ' + str(RESPONSE_CACHE.hits)
+                     + ' hits, ' + str(RESPONSE_CACHE.misses) + ' misses')
+    RESPONSE_CACHE.close()
+SESSION.close()
 print_status('Script complete!')